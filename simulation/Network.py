@@ -3,47 +3,123 @@ import socket
 import threading
 from time import sleep
 import random
+import selectors
 import RDT
 import sys
+from link import Link
 from utils import debug_log
 
 # TCP + IP + Ethernet headers size
 HEADER_TCP_IP = 66
+# UDP + IP + Ethernet headers size
+HEADER_UDP_IP = 42
 
-## Provides an abstraction for the network layer
-class NetworkLayer:
+## Faults injected on the frames sent, shared by every network layer
+class FaultInjection:
     # configuration parameters
     prob_pkt_loss = 0
     prob_byte_corr = 0
     prob_pkt_reorder = 0
+    reorder_msg_S = None
+    # bytes at the start of a frame never corrupted, set from the codec in use
+    corrupt_offset = RDT.Packet.length_S_length
+    # source of the faults, a seeded random.Random makes them reproducible
+    rng = random
+
+    ## Returns the frames to send in place of msg_S: none if it is dropped or
+    ## held back, and two if a frame held back before goes along with it
+    def _inject_faults(self, msg_S) -> list:
+        # return without sending if the packet is being dropped
+        if self.rng.random() < self.prob_pkt_loss:
+            return []
+        # corrupt a packet
+        offset = self.corrupt_offset
+        if self.rng.random() < self.prob_byte_corr and len(msg_S) > offset:
+            start = self.rng.randint(offset, max(offset, len(msg_S) - 5))
+            num = self.rng.randint(1, min(5, len(msg_S) - start))
+            repl_S = b'X' * num
+            msg_S = msg_S[:start] + repl_S + msg_S[start + num:]
+        # reorder packets - either hold a packet back, or if one held back then send both
+        frames = [msg_S]
+        if self.rng.random() < self.prob_pkt_reorder or self.reorder_msg_S:
+            if self.reorder_msg_S is None:
+                self.reorder_msg_S = msg_S
+                return []
+            else:
+                frames.append(self.reorder_msg_S)
+                self.reorder_msg_S = None
+        return frames
+
+
+## Provides an abstraction for the network layer
+class NetworkLayer(FaultInjection):
+    # maximum number of bytes read from the socket at once
+    recv_size = 64 * 1024
+    # largest UDP datagram, every frame must fit in one
+    max_datagram = 65507
 
     # class variables
     sock = None
     conn = None
-    buffer_S = ''
-    lock = threading.Lock()
     collect_thread = None
     stop = None
-    socket_timeout = 0.1
-    reorder_msg_S = None
     # Stats variables
     bytes_sent = 0
     bytes_recv = 0
 
-    def __init__(self, role_S, server_S, port):
-        if role_S == 'client':
+    def __init__(self, role_S, server_S, port, recv_size=None, transport='tcp', link: Link=None):
+        if recv_size is not None:
+            self.recv_size = recv_size
+        if transport not in ('tcp', 'udp'):
+            raise ValueError(f'Unknown transport: {transport}')
+        # 'tcp' sends frames over a byte stream, 'udp' sends each frame in its
+        # own datagram and leaves reliability to the layer above
+        self.transport = transport
+        self.header_size = HEADER_TCP_IP if transport == 'tcp' else HEADER_UDP_IP
+        # chunks received and not yet delivered, guarded by lock
+        self.chunks = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.data_ready = threading.Condition(self.lock)
+        # sends are serialized apart from the receive buffer, so a send blocked
+        # on a full socket never stops the collector from draining it
+        self.send_lock = threading.Lock()
+        # emulated outgoing link, frames are sent when they would arrive on it
+        self.link = link or Link()
+
+        if role_S == 'client' and transport == 'tcp':
             debug_log('Network: role is client')
             self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.conn.connect((server_S, port))
-            self.conn.settimeout(self.socket_timeout)
 
-        elif role_S == 'server':
+        elif role_S == 'server' and transport == 'tcp':
             debug_log('Network: role is server')
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.bind(('', port))
             self.sock.listen(1)
             self.conn, addr = self.sock.accept()
-            self.conn.settimeout(self.socket_timeout)
+
+        elif role_S == 'client':
+            debug_log('Network: role is client (udp)')
+            self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.conn.connect((server_S, port))
+
+        elif role_S == 'server':
+            debug_log('Network: role is server (udp)')
+            self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.conn.bind(('', port))
+            # There is no accept, the first datagram tells who the client is.
+            # It's only peeked, so the collector still receives it
+            _, addr = self.conn.recvfrom(self.max_datagram, socket.MSG_PEEK)
+            self.conn.connect(addr)
+            debug_log(f'Network: client is {addr}')
+
+        # the collector sleeps on the selector until the connection is readable
+        # or disconnect writes to the wakeup socket
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.conn, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
 
         # start the thread to receive data on the connection
         self.collect_thread = threading.Thread(name='Collector', target=self.collect)
@@ -51,74 +127,199 @@ class NetworkLayer:
         self.collect_thread.start()
 
     def disconnect(self):
+        self.link.stop()
         if self.collect_thread:
             self.stop = True
+            self.wakeup_w.send(b'\0')
             self.collect_thread.join()
+            self.collect_thread = None
+            self.selector.close()
+            self.wakeup_r.close()
+            self.wakeup_w.close()
 
     def __del__(self):
         if self.sock is not None: self.sock.close()
         if self.conn is not None: self.conn.close()
 
     def udt_send(self, msg_S):
-        # return without sending if the packet is being dropped
-        if random.random() < self.prob_pkt_loss:
-            return
-        # corrupt a packet
-        if random.random() < self.prob_byte_corr:
-            start = random.randint(RDT.Packet.length_S_length, len(msg_S) - 5)
-            num = random.randint(1, 5)
-            repl_S = ''.join(random.sample('XXXXX', num))  # sample length >= num
-            msg_S = msg_S[:start] + repl_S + msg_S[start + num:]
-        # reorder packets - either hold a packet back, or if one held back then send both
-        if random.random() < self.prob_pkt_reorder or self.reorder_msg_S:
-            if self.reorder_msg_S is None:
-                self.reorder_msg_S = msg_S
-                return None
-            else:
-                msg_S += self.reorder_msg_S
-                self.reorder_msg_S = None
+        # frames are sent as bytes, strings are only kept for the RDT 3.0 layer
+        if isinstance(msg_S, str):
+            msg_S = msg_S.encode('utf-8')
 
+        with self.send_lock:
+            frames = self._inject_faults(msg_S)
+            for frame in frames:
+                self.link.transmit(frame, self._send_frame, len(frame) + self.header_size)
+
+    def _send_frame(self, msg_S):
+        if self.transport == 'udp':
+            self._send_datagram(msg_S)
+        else:
+            self._send_stream(msg_S)
+
+    def _send_stream(self, msg_S):
         # keep calling send until all the bytes are transferred
-        with self.lock:
-            totalsent = 0
-            while totalsent < len(msg_S):
-                sent = self.conn.send(msg_S[totalsent:].encode('utf-8'))
-                if sent == 0:
-                    raise RuntimeError("socket connection broken")
-                self.bytes_sent += sent + HEADER_TCP_IP
-                totalsent = totalsent + sent
+        totalsent = 0
+        while totalsent < len(msg_S):
+            sent = self.conn.send(msg_S[totalsent:])
+            if sent == 0:
+                raise RuntimeError("socket connection broken")
+            self.bytes_sent += sent + self.header_size
+            totalsent = totalsent + sent
+
+    def _send_datagram(self, msg_S):
+        if len(msg_S) > self.max_datagram:
+            raise ValueError(f'Frame of {len(msg_S)} bytes does not fit in a datagram')
+        try:
+            self.conn.send(msg_S)
+        except ConnectionRefusedError:
+            # the other end is not listening (yet), same as a lost packet
+            return
+        self.bytes_sent += len(msg_S) + self.header_size
 
 
     ## Receive data from the network and save in internal buffer
     def collect(self):
-        while (True):
-            try:
-                recv_bytes = self.conn.recv(2048)
-                with self.lock:
-                    decoded_bytes = recv_bytes.decode('utf-8')
-                    self.buffer_S += decoded_bytes
-                    bytes_len = len(decoded_bytes)
-                    if bytes_len > 0:
-                        self.bytes_recv += bytes_len + HEADER_TCP_IP
-            except BlockingIOError as err:
-                pass
-            except socket.timeout as err:
-                pass
-            if self.stop:
-                return
+        while not self.stop:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup_r:
+                    return
+                try:
+                    recv_bytes = self.conn.recv(max(self.recv_size, self.max_datagram)
+                                                if self.transport == 'udp' else self.recv_size)
+                except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+                    continue
+                except OSError:
+                    recv_bytes = b''
+                if len(recv_bytes) == 0 and self.transport == 'udp':
+                    continue
+                with self.data_ready:
+                    if len(recv_bytes) == 0:
+                        # connection closed by the other end
+                        self.closed = True
+                        self.data_ready.notify_all()
+                        return
+                    self.chunks.append(recv_bytes)
+                    self.bytes_recv += len(recv_bytes) + self.header_size
+                    self.data_ready.notify_all()
+
+    ## Deliver collected data to client. Waits up to timeout seconds for data
+    ## to arrive (forever if None) and returns b'' if nothing was received.
+    def udt_receive(self, timeout=0):
+        with self.data_ready:
+            if not self.chunks and not self.closed and timeout != 0:
+                self.data_ready.wait_for(lambda: self.chunks or self.closed, timeout)
+            ret = b''.join(self.chunks)
+            self.chunks = []
+        return ret
+
+    ## Whether the connection is closed and everything received was delivered,
+    ## from then on udt_receive returns b'' right away
+    def is_closed(self) -> bool:
+        with self.data_ready:
+            return self.closed and not self.chunks
 
-    ## Deliver collected data to client
-    def udt_receive(self):
+    def get_stats(self):
         with self.lock:
-            ret_S = self.buffer_S
-            self.buffer_S = ''
-        return ret_S
+            return {
+                'bytes_sent': self.bytes_sent,
+                'bytes_recv': self.bytes_recv,
+                'link': self.link.get_stats(),
+            }
+
+
+class LoopbackNetworkLayer(FaultInjection):
+    """In-memory network layer connecting two endpoints of the same process.
+
+    Has the same udt_send/udt_receive interface as NetworkLayer, without any
+    socket: the frames sent by one end are appended to the receive buffer of the
+    other, right away or through an emulated link. Each direction has its own
+    fault rates, link and random generators, so a run with the same seeds drops,
+    corrupts and reorders the same frames.
+    """
+    # no link headers, the stats only count the frames
+    header_size = 0
+    # Stats variables
+    bytes_sent = 0
+    bytes_recv = 0
+
+    def __init__(self, seed=None, prob_pkt_loss=0, prob_byte_corr=0, prob_pkt_reorder=0, link: Link=None):
+        self.rng = random.Random(seed)
+        self.link = link or Link()
+        self.prob_pkt_loss = prob_pkt_loss
+        self.prob_byte_corr = prob_byte_corr
+        self.prob_pkt_reorder = prob_pkt_reorder
+        self.peer = None
+        # chunks received and not yet delivered, guarded by lock
+        self.chunks = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.data_ready = threading.Condition(self.lock)
+        self.send_lock = threading.Lock()
+
+    ## Returns two connected endpoints. The seed of each direction is derived
+    ## from seed, and the fault rates apply to both unless given per end as
+    ## client/server dicts. link holds the Link parameters of both directions
+    @classmethod
+    def pair(cls, seed=None, client: dict=None, server: dict=None, link: dict=None, **faults):
+        def end(name, own):
+            end_seed = None if seed is None else f'{seed}:{name}'
+            end_link = Link(**{**(link or {}), 'seed': None if seed is None else f'{end_seed}:link'})
+            return cls(end_seed, link=end_link, **{**faults, **(own or {})})
+        a = end('client', client)
+        b = end('server', server)
+        a.peer = b
+        b.peer = a
+        return a, b
+
+    def disconnect(self):
+        for end in (self, self.peer):
+            if end is None:
+                continue
+            end.link.stop()
+            with end.data_ready:
+                end.closed = True
+                end.data_ready.notify_all()
+
+    def udt_send(self, msg_S):
+        if isinstance(msg_S, str):
+            msg_S = msg_S.encode('utf-8')
+
+        with self.send_lock:
+            if self.closed:
+                return
+            frames = self._inject_faults(msg_S)
+            for frame in frames:
+                self.bytes_sent += len(frame) + self.header_size
+                self.link.transmit(frame, self.peer._deliver)
+
+    def _deliver(self, frame: bytes):
+        with self.data_ready:
+            self.chunks.append(frame)
+            self.bytes_recv += len(frame) + self.header_size
+            self.data_ready.notify_all()
+
+    ## Same as NetworkLayer.udt_receive
+    def udt_receive(self, timeout=0):
+        with self.data_ready:
+            if not self.chunks and not self.closed and timeout != 0:
+                self.data_ready.wait_for(lambda: self.chunks or self.closed, timeout)
+            ret = b''.join(self.chunks)
+            self.chunks = []
+        return ret
+
+    ## Whether the connection is closed and everything received was delivered,
+    ## from then on udt_receive returns b'' right away
+    def is_closed(self) -> bool:
+        with self.data_ready:
+            return self.closed and not self.chunks
 
     def get_stats(self):
         with self.lock:
             return {
                 'bytes_sent': self.bytes_sent,
                 'bytes_recv': self.bytes_recv,
+                'link': self.link.get_stats(),
             }
 
 
@@ -127,18 +328,19 @@ if __name__ == '__main__':
     parser.add_argument('role', help='Role is either client or server.', choices=['client', 'server'])
     parser.add_argument('server', help='Server.')
     parser.add_argument('port', help='Port.', type=int)
+    parser.add_argument('--transport', help='Transport.', choices=['tcp', 'udp'], default='tcp')
     args = parser.parse_args()
 
-    network = NetworkLayer(args.role, args.server, args.port)
+    network = NetworkLayer(args.role, args.server, args.port, transport=args.transport)
     if args.role == 'client':
         network.udt_send('MSG_FROM_CLIENT')
         sleep(2)
-        print(network.udt_receive())
+        print(network.udt_receive().decode('utf-8'))
         network.disconnect()
 
     else:
         sleep(1)
-        print(network.udt_receive())
+        print(network.udt_receive().decode('utf-8'))
         network.udt_send('MSG_FROM_SERVER')
         network.disconnect()
 
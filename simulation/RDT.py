@@ -3,9 +3,19 @@ import argparse
 import time
 from time import sleep
 import hashlib
+import struct
+import zlib
 from utils import debug_log
+from checksum import Checksum, CRC32, MD5, get_checksum
 
 ACK = "1"
+# Data frame of a stream other than 0, text codec only
+STREAM = "S"
+# Highest stream id. Ids fit the binary codec's 2 byte field, the one above is
+# kept for the connection itself
+MAX_STREAM = 0xfffe
+# Stream of the messages setting up a connection, never compressed
+CONTROL_STREAM = MAX_STREAM + 1
 
 class Packet:
     # the number of bytes used to store packet length
@@ -15,14 +25,22 @@ class Packet:
     checksum_length = 32
     ack_length = 1
 
-    def __init__(self, seq_num, msg_S='', ack=False):
+    def __init__(self, seq_num, msg_S='', ack=False, sack=(), stream=0, fin=False):
         self.seq_num = seq_num
+        # Payload, bytes through the codecs and a str in the RDT 3.0 text format
         self.msg_S = msg_S
         self.ack = ack
+        # On ACK packets seq_num is the cumulative ACK (next seq expected) and
+        # sack lists the [start, end) ranges received beyond it
+        self.sack = sack
+        # Logical stream of the data and whether it is the last of the stream.
+        # Sequence numbers are shared by every stream of a connection
+        self.stream = stream
+        self.fin = fin
 
     @classmethod
-    def from_byte_S(self, byte_S):
-        if Packet.corrupt(byte_S):
+    def from_byte_S(self, byte_S, verified=False):
+        if not verified and Packet.corrupt(byte_S):
             raise RuntimeError('Cannot initialize Packet: byte_S is corrupt')
 
         # extract the fields
@@ -64,50 +82,289 @@ class Packet:
         return self.ack
 
 
-prev_data_buffer = ''
-def getPackets(data: str) -> ([Packet], bool):
-    global prev_data_buffer
-    parsed_packets = []
-    counter = 0
-    corrupt = False
-
-    data_stream = prev_data_buffer + data
-
-    # debug_log('\n\n')
-    # debug_log(f"datastream: {data_stream}")
-    # debug_log('\n\n')
-    try:
-        while data_stream != "":
-            packet_len = int(data_stream[:Packet.length_S_length])    
-
-            # Sanity check to guarantee that the remaining data is greater or equal
-            # than the parsed packet length, otherwise, we would have a runtime error.
-            # Saves data into a buffer for later use.
-            if len(data_stream) < packet_len:
-                prev_data_buffer = data_stream
-                return (parsed_packets, False)
-
-            packet_stream = data_stream[:packet_len]
-            # debug_log(f"getPackets P{counter+1}: {packet_stream}")
-            data_stream = data_stream[packet_len:]
-
-            # If one of the packets is corrupt, stop execution and return parsed packets
-            if Packet.corrupt(packet_stream):
-                debug_log("getPackets: Found corrupt packet in data stream, aborting parsing...")
-                corrupt = True
+class TextCodec:
+    """Original wire format: zero-padded decimal fields and an hex digest.
+
+    The checksum defaults to MD5 so frames stay compatible with Packet.get_byte_S.
+    Data of a stream other than 0, or with fin set, is marked with STREAM in the
+    ack field and its payload starts with the stream id and fin flag in decimal.
+    """
+    name = 'text'
+    sync_length = 0
+    # Faults spare the length field, framing can't be recovered once it's hit
+    corrupt_offset = Packet.length_S_length
+    stream_id_length = 5
+    # offsets of the fixed fields
+    seq_num_offset = Packet.length_S_length
+    ack_offset = seq_num_offset + Packet.seq_num_S_length
+    checksum_offset = ack_offset + Packet.ack_length
+
+    def __init__(self, checksum: Checksum=None):
+        self.checksum = checksum or MD5()
+        self.header_length = self.checksum_offset + self.checksum.hexsize()
+
+    def encode(self, pkt: Packet) -> bytes:
+        # Same layout as Packet.get_byte_S, but the length field counts encoded
+        # bytes so frames can be split on the raw byte stream
+        ack_S = str(int(pkt.ack))
+        if pkt.ack:
+            payload = ','.join(f'{start}-{end}' for start, end in pkt.sack).encode('utf-8')
+        else:
+            payload = pkt.msg_S.encode('utf-8') if isinstance(pkt.msg_S, str) else pkt.msg_S
+            if pkt.stream or pkt.fin:
+                ack_S = STREAM
+                payload = f'{pkt.stream:0{self.stream_id_length}d}{int(pkt.fin)}'.encode('utf-8') + payload
+        seq_num_S = str(pkt.seq_num).zfill(Packet.seq_num_S_length)
+        length_S = str(self.header_length + len(payload)).zfill(Packet.length_S_length)
+        head = (length_S + seq_num_S + ack_S).encode('utf-8')
+        return b''.join((head, self.checksum.compute(head, payload).hex().encode('utf-8'), payload))
+
+    def frame_length(self, data, offset=0):
+        if len(data) - offset < Packet.length_S_length:
+            return None
+        return int(bytes(data[offset:offset + Packet.length_S_length]))
+
+    # The text format has no sync marker, framing can't be recovered once lost
+    def find_sync(self, data, start) -> int:
+        return -1
+
+    def corrupt(self, frame) -> bool:
+        return self.decode(frame) is None
+
+    # Verifies and parses a frame in a single pass, returns None if it is corrupt
+    def decode(self, frame):
+        frame = memoryview(frame)
+        if len(frame) < self.header_length:
+            return None
+        checksum_S = frame[self.checksum_offset:self.header_length]
+        computed = self.checksum.compute(frame[:self.checksum_offset], frame[self.header_length:])
+        if computed.hex().encode('utf-8') != checksum_S:
+            return None
+        try:
+            seq_num = int(bytes(frame[self.seq_num_offset:self.ack_offset]))
+            msg_S = bytes(frame[self.header_length:])
+            if frame[self.ack_offset] == ord(ACK):
+                sack = [tuple(int(n) for n in block.split(b'-')) for block in msg_S.split(b',') if block]
+                return Packet(seq_num, ack=True, sack=sack)
+            if frame[self.ack_offset] == ord(STREAM):
+                stream = int(msg_S[:self.stream_id_length])
+                fin = msg_S[self.stream_id_length:self.stream_id_length + 1] == b'1'
+                return Packet(seq_num, msg_S[self.stream_id_length + 1:], stream=stream, fin=fin)
+        except ValueError:
+            return None
+        return Packet(seq_num, msg_S)
+
+
+class BinaryCodec:
+    """Fixed-size struct packed header followed by the raw payload.
+
+    Header layout (network byte order):
+        sync (2B) | version (1B) | checksum id (4b) + flags (4b) | frame length (4B) |
+        seq number (4B) | header check (2B) | checksum
+    The header check protects the fields before it, so the frame length can be
+    trusted once it matches. The checksum covers the header fields and the
+    payload, its length depends on the algorithm used (4 bytes for CRC32 and
+    Adler-32, 16 bytes for MD5). Data of a stream other than 0 has FLAG_STREAM
+    set and a 2 byte stream id before the payload.
+    """
+    name = 'binary'
+    VERSION = 2
+    SYNC = b'\xa5\x5a'
+    FLAG_ACK = 0x01
+    FLAG_STREAM = 0x02
+    FLAG_FIN = 0x04
+    FLAGS_MASK = 0x0f
+
+    header = struct.Struct('!2sBBII')
+    header_check = struct.Struct('!H')
+    stream_id = struct.Struct('!H')
+    # ACK payload, one per SACK block
+    sack_block = struct.Struct('!II')
+    sync_length = len(SYNC)
+    # Any byte can be corrupted, the decoder finds the next sync marker
+    corrupt_offset = 0
+
+    def __init__(self, checksum: Checksum=None):
+        self.checksum = checksum or CRC32()
+        self.checksum_offset = self.header.size + self.header_check.size
+        self.header_length = self.checksum_offset + self.checksum.size
+        self._checksum_bits = self.checksum.id << 4
+
+    def encode(self, pkt: Packet) -> bytes:
+        flags = self._checksum_bits
+        if pkt.ack:
+            flags |= self.FLAG_ACK
+            payload = b''.join(self.sack_block.pack(start, end) for start, end in pkt.sack)
+        else:
+            payload = pkt.msg_S.encode('utf-8') if isinstance(pkt.msg_S, str) else pkt.msg_S
+            if pkt.stream:
+                flags |= self.FLAG_STREAM
+                payload = self.stream_id.pack(pkt.stream) + payload
+            if pkt.fin:
+                flags |= self.FLAG_FIN
+        head = self.header.pack(self.SYNC, self.VERSION, flags, self.header_length + len(payload), pkt.seq_num)
+        head_check = self.header_check.pack(zlib.crc32(head) & 0xffff)
+        return b''.join((head, head_check, self.checksum.compute(head, payload), payload))
+
+    def frame_length(self, data, offset=0):
+        if len(data) - offset < self.checksum_offset:
+            return None
+        sync, version, flags, length, _ = self.header.unpack_from(data, offset)
+        if sync != self.SYNC:
+            raise ValueError('Frame does not start with sync marker')
+        head_check, = self.header_check.unpack_from(data, offset + self.header.size)
+        if zlib.crc32(data[offset:offset + self.header.size]) & 0xffff != head_check:
+            raise ValueError('Corrupt frame header')
+        if version != self.VERSION:
+            raise ValueError(f'Unknown frame version: {version}')
+        if flags & ~self.FLAGS_MASK != self._checksum_bits:
+            raise ValueError(f'Unexpected checksum id: {flags >> 4}')
+        return length
+
+    # Position of the next possible frame start at or after start, -1 if none
+    def find_sync(self, data, start) -> int:
+        return data.find(self.SYNC, start)
+
+    def corrupt(self, frame) -> bool:
+        return self.decode(frame) is None
+
+    # Verifies and parses a frame in a single pass, returns None if it is corrupt
+    def decode(self, frame):
+        frame = memoryview(frame)
+        if len(frame) < self.header_length:
+            return None
+        computed = self.checksum.compute(frame[:self.header.size], frame[self.header_length:])
+        if computed != frame[self.checksum_offset:self.header_length]:
+            return None
+        _, _, flags, _, seq_num = self.header.unpack_from(frame)
+        payload = frame[self.header_length:]
+        if flags & self.FLAG_ACK:
+            if len(payload) % self.sack_block.size:
+                return None
+            return Packet(seq_num, ack=True, sack=list(self.sack_block.iter_unpack(payload)))
+        stream = 0
+        if flags & self.FLAG_STREAM:
+            if len(payload) < self.stream_id.size:
+                return None
+            stream, = self.stream_id.unpack_from(payload)
+            payload = payload[self.stream_id.size:]
+        # copied out of the receive buffer, which is reused
+        return Packet(seq_num, bytes(payload), stream=stream, fin=bool(flags & self.FLAG_FIN))
+
+
+CODECS = {
+    TextCodec.name: TextCodec,
+    BinaryCodec.name: BinaryCodec,
+}
+
+def get_codec(name: str, checksum: str=None):
+    if name not in CODECS:
+        raise ValueError(f'Unknown codec: {name}')
+    return CODECS[name](get_checksum(checksum) if checksum else None)
+
+
+class FrameDecoder:
+    """Incremental frame parser, one instance per connection.
+
+    Received bytes are appended to a bytearray and consumed by advancing a read
+    offset, so each byte is only copied once into the buffer. The consumed
+    prefix is dropped only when it gets big enough to be worth it.
+
+    A frame failing its checksum is skipped on its own. If a frame header is
+    damaged, the decoder scans forward for the next valid header using the
+    codec sync marker; codecs without one lose every byte buffered after it.
+    """
+    # minimum consumed bytes before the buffer is compacted
+    compact_threshold = 64 * 1024
+    # headers announcing bigger frames are considered damaged
+    max_frame_length = 16 * 1024 * 1024
+
+    def __init__(self, codec=None):
+        self.codec = codec or TextCodec()
+        self.buffer = bytearray()
+        self.offset = 0
+        # set while looking for a valid header after a damaged one
+        self.resyncing = False
+        # Stats variables
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset >= self.compact_threshold and 2 * self.offset >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def discard(self):
+        self.skipped_bytes += len(self.buffer) - self.offset
+        self.buffer.clear()
+        self.offset = 0
+
+    def pending(self) -> int:
+        return len(self.buffer) - self.offset
+
+    # Yields every complete frame in the buffer as a memoryview slice. The slices
+    # point to the internal buffer, so they must be released before the next feed.
+    # Raises ValueError if the header of the next frame can't be parsed.
+    def frames(self):
+        buffer = self.buffer
+        with memoryview(buffer) as view:
+            while True:
+                length = self.codec.frame_length(buffer, self.offset)
+                if length is None or len(buffer) - self.offset < length:
+                    return
+                if not self.codec.header_length <= length <= self.max_frame_length:
+                    raise ValueError(f'Invalid frame length: {length}')
+                frame = view[self.offset:self.offset + length]
+                self.offset += length
+                yield frame
+
+    # Moves the read offset to the next sync marker. Returns False if there is
+    # none in the buffer yet, keeping only the bytes that could start one.
+    def _resync(self) -> bool:
+        pos = self.codec.find_sync(self.buffer, self.offset + 1)
+        found = pos >= 0
+        if not found:
+            keep = max(self.codec.sync_length - 1, 0)
+            pos = max(self.offset + 1, len(self.buffer) - keep)
+        self.skipped_bytes += pos - self.offset
+        self.offset = pos
+        return found
+
+    # Feeds data into the decoder and returns the valid packets completed by it,
+    # along with the number of corrupt frames found.
+    def get_packets(self, data: bytes) -> ([Packet], int):
+        self.feed(data)
+        parsed_packets = []
+        corrupted = 0
+
+        while True:
+            try:
+                for frame in self.frames():
+                    self.resyncing = False
+                    length = len(frame)
+                    packet = self.codec.decode(frame)
+                    frame.release()
+                    if packet is None:
+                        # The header was valid, so only this frame is lost
+                        self.skipped_bytes += length
+                        corrupted += 1
+                        continue
+                    parsed_packets.append(packet)
                 break
+            except ValueError:
+                if not self.resyncing:
+                    debug_log("FrameDecoder: Found corrupt frame header, resynchronizing...")
+                    corrupted += 1
+                    self.resyncing = True
+                if not self._resync():
+                    break
 
-            parsed_packets.append(Packet.from_byte_S(packet_stream))
-            counter += 1
+        debug_log(f"FrameDecoder: Found {len(parsed_packets)} packets")
+        return (parsed_packets, corrupted)
 
-    except Exception:
-        debug_log("getPackets: Found corrupt packet in data stream, aborting parsing...")
-        corrupt = True
-
-    prev_data_buffer = ''
-    debug_log(f"getPackets: Found {len(parsed_packets)} packets")
-    return (parsed_packets, corrupt)
- 
 
 class RDT:
     # latest sequence number used in a packet
@@ -133,7 +390,8 @@ class RDT:
 
             # Waiting for ack/nak
             while response == '' and timer + self.timeout > time.time():
-                response = self.network.udt_receive()
+                remaining = timer + self.timeout - time.time()
+                response = self.network.udt_receive(timeout=max(remaining, 0)).decode('utf-8')
 
             if response == '':
                 continue
@@ -144,7 +402,7 @@ class RDT:
             self.byte_buffer = response[msg_length:]
 
             if not Packet.corrupt(response[:msg_length]):
-                response_p = Packet.from_byte_S(response[:msg_length])
+                response_p = Packet.from_byte_S(response[:msg_length], verified=True)
                 if response_p.seq_num < self.seq_num:
                     # It's trying to send me data again
                     debug_log("SENDER: Receiver behind sender")
@@ -163,7 +421,7 @@ class RDT:
 
     def rdt_3_0_receive(self):
         ret_S = None
-        byte_S = self.network.udt_receive()
+        byte_S = self.network.udt_receive().decode('utf-8')
         self.byte_buffer += byte_S
         current_seq = self.seq_num
         # Don't move on until seq_num has been toggled
@@ -178,14 +436,14 @@ class RDT:
                 break  # not enough bytes to read the whole packet
 
             # Check if packet is corrupt
-            if Packet.corrupt(self.byte_buffer):
+            if Packet.corrupt(self.byte_buffer[0:length]):
                 # Send a NAK
                 debug_log("RECEIVER: Corrupt packet, sending NAK.")
                 answer = Packet(self.seq_num, "0")
                 self.network.udt_send(answer.get_byte_S())
             else:
                 # create packet from buffer content
-                p = Packet.from_byte_S(self.byte_buffer[0:length])
+                p = Packet.from_byte_S(self.byte_buffer[0:length], verified=True)
                 # Check packet
                 if p.is_ack_pack():
                     self.byte_buffer = self.byte_buffer[length:]
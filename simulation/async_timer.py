@@ -1,25 +1,26 @@
-from threading import Timer
 from typing import Callable
+from timer_wheel import TimerWheel, get_default_wheel
 
 class AsyncTimer:
-    timer = None
+    handle = None
 
-    def __init__(self, timeout_sec: float, callback: Callable[[any], any], args=[]):
+    def __init__(self, timeout_sec: float, callback: Callable[[any], any], args=[], scheduler: TimerWheel=None):
         self.timeout = timeout_sec
         self.callback = callback
         self.args = args
+        # Timers are armed on a shared wheel instead of spawning a thread each
+        self.scheduler = scheduler or get_default_wheel()
 
     def start(self):
-        if self.timer != None:
-            self.timer.cancel()
-    
-        self.timer = Timer(self.timeout, self.callback, args=self.args)
-        self.timer.start()
+        if self.handle != None:
+            self.scheduler.cancel(self.handle)
+
+        self.handle = self.scheduler.schedule(self.timeout, self.callback, args=self.args)
 
     def stop(self):
-        if self.timer != None:
-            self.timer.cancel()
-        self.timer = None
+        if self.handle != None:
+            self.scheduler.cancel(self.handle)
+        self.handle = None
 
     def change_timeout(self, timeout: float):
-        self.timeout = timeout
\ No newline at end of file
+        self.timeout = timeout
@@ -0,0 +1,88 @@
+import sys, argparse
+from time import perf_counter
+
+# Hacky fix to import from parent folder
+path_slip = __file__.split('/')
+sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
+
+from RDT import Packet, FrameDecoder, get_codec
+import constants as c
+
+# Previous implementation of the receive path parser, kept as the reference for
+# this benchmark. It keeps leftover bytes in a module global and re-slices the
+# whole stream after every frame.
+prev_data_buffer = b''
+def getPackets(data: bytes, codec) -> ([Packet], bool):
+    global prev_data_buffer
+    parsed_packets = []
+    corrupt = False
+
+    data_stream = prev_data_buffer + data
+    try:
+        while data_stream != b"":
+            packet_len = codec.frame_length(data_stream)
+            if packet_len is None or len(data_stream) < packet_len:
+                prev_data_buffer = data_stream
+                return (parsed_packets, False)
+
+            packet_stream = data_stream[:packet_len]
+            data_stream = data_stream[packet_len:]
+
+            packet = codec.decode(packet_stream)
+            if packet is None:
+                corrupt = True
+                break
+            parsed_packets.append(packet)
+
+    except Exception:
+        corrupt = True
+
+    prev_data_buffer = b''
+    return (parsed_packets, corrupt)
+
+def make_burst(codec, size: int, packet_size: int) -> bytes:
+    frames = []
+    total = 0
+    seq = 0
+    while total < size:
+        frame = codec.encode(Packet(seq, b'x' * packet_size))
+        frames.append(frame)
+        total += len(frame)
+        seq += 1
+    return b''.join(frames), seq
+
+def split(data: bytes, chunk_size: int) -> list:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+def run(parse, chunks) -> (float, int):
+    start = perf_counter()
+    count = 0
+    for chunk in chunks:
+        pkts, _ = parse(chunk)
+        count += len(pkts)
+    return perf_counter() - start, count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares getPackets with FrameDecoder.')
+    parser.add_argument('--size', help='Burst size in bytes.', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--packet-size', help='Payload size.', type=int, default=c.PACKET_SIZE)
+    parser.add_argument('--chunks', help='Chunk sizes fed to the parsers (0 = whole burst).',
+                        type=int, nargs='+', default=[0, 65536, 2048])
+    parser.add_argument('--codec', help='Codec.', default=c.CODEC)
+    args = parser.parse_args()
+
+    codec = get_codec(args.codec, c.CHECKSUM)
+    burst, n_pkts = make_burst(codec, args.size, args.packet_size)
+    print(f'Burst: {len(burst)} bytes, {n_pkts} packets, codec: {codec.name}')
+
+    for chunk_size in args.chunks:
+        chunks = split(burst, chunk_size) if chunk_size else [burst]
+        old_time, old_count = run(lambda d: getPackets(d, codec), chunks)
+        decoder = FrameDecoder(codec)
+        new_time, new_count = run(decoder.get_packets, chunks)
+        assert old_count == new_count == n_pkts
+
+        label = f'{chunk_size} B chunks' if chunk_size else 'single burst'
+        print(f'{label:>18}: getPackets {old_time:8.3f}s  FrameDecoder {new_time:8.3f}s  '
+              f'speedup {old_time/new_time:6.1f}x')
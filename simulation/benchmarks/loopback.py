@@ -0,0 +1,135 @@
+import sys, argparse
+from threading import Thread, Condition
+from time import perf_counter
+
+# Hacky fix to import from parent folder
+path_slip = __file__.split('/')
+sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
+sys.path.append('/'.join(path_slip[0:len(path_slip)-2] + ['selective_repeat']))
+
+from Network import LoopbackNetworkLayer
+from RDT import get_codec
+from congestion import get_controller
+from compression import get_compressor
+from link import JITTER
+from sender import Sender
+from receiver import Receiver
+import constants as c
+import utils
+
+# Transfers data from a client to a server over an in-memory channel, or over the
+# (client, server) network layers given as conns, and returns the stats of the
+# transfer. The client's receiver only handles the ACKs. Both ends use the
+# compression given, with no negotiation
+def run_transfer(
+    data: bytes, seed=None,
+    loss=0, corruption=0, reorder=0,
+    ws=c.WINDOW_SIZE, timeout_sec=c.TIMEOUT, congestion=c.CONGESTION,
+    codec=c.CODEC, checksum=c.CHECKSUM, packet_size=c.PACKET_SIZE,
+    link: dict=None, conns: tuple=None,
+    compression='none', level=c.COMPRESSION_LEVEL
+) -> dict:
+    if conns is None:
+        conns = LoopbackNetworkLayer.pair(
+            seed, prob_pkt_loss=loss, prob_byte_corr=corruption, prob_pkt_reorder=reorder, link=link
+        )
+    client_conn, server_conn = conns
+    codec = get_codec(codec, checksum)
+    sender = Sender(
+        client_conn, ws=ws, timeout_sec=timeout_sec, codec=codec, cc=get_controller(congestion),
+        compressor=get_compressor(compression, level)
+    )
+    client_recver = Receiver(client_conn, sender.notify_ack, ws=ws, codec=codec)
+    server_sender = Sender(server_conn, ws=ws, timeout_sec=timeout_sec, codec=codec)
+    server_recver = Receiver(
+        server_conn, server_sender.notify_ack, ws=ws, codec=codec, compressor=get_compressor(compression, level)
+    )
+
+    received = []
+    received_len = 0
+    done = Condition()
+    def recv_callback(msg: bytes):
+        nonlocal received_len
+        with done:
+            received.append(msg)
+            received_len += len(msg)
+            done.notify()
+
+    threads = [
+        Thread(target=sender.run),
+        Thread(target=server_sender.run),
+        Thread(target=client_recver.run, args=[lambda msg: None]),
+        Thread(target=server_recver.run, args=[recv_callback]),
+    ]
+    for t in threads: t.start()
+
+    start = perf_counter()
+    for chunk in utils.getChunks(packet_size, data):
+        sender.send(chunk)
+    with done:
+        done.wait_for(lambda: received_len >= len(data))
+    elapsed_time = perf_counter() - start
+
+    stats = {
+        'elapsed_time': elapsed_time,
+        'goodput': len(data)*8/elapsed_time,
+        'ok': b''.join(received) == data,
+        **sender.get_stats(),
+        'corrupted_pkts': server_recver.get_stats()['corrupted_pkts'],
+        'link_drops': sum(client_conn.link.get_stats()[k] for k in ('queue_drops', 'red_drops')),
+    }
+
+    for end in (sender, server_sender, client_recver, server_recver): end.stop()
+    client_conn.disconnect()
+    server_conn.disconnect()
+    for t in threads: t.join()
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Selective repeat throughput over an in-memory channel.')
+    parser.add_argument('--size', help='Bytes transferred.', type=int, default=1024 * 1024)
+    parser.add_argument('--seed', help='Seed of the fault generators.', type=int, default=0)
+    parser.add_argument('--loss', help='Packet loss probability.', type=float, default=0)
+    parser.add_argument('--corruption', help='Packet corruption probability.', type=float, default=0)
+    parser.add_argument('--reorder', help='Packet reorder probability.', type=float, default=0)
+    parser.add_argument('--window', help='Window size.', type=int, default=c.WINDOW_SIZE)
+    parser.add_argument('--congestion', help='Congestion controller.', default=c.CONGESTION)
+    parser.add_argument('--delay', help='One-way link delay, in seconds.', type=float, default=c.LINK_DELAY)
+    parser.add_argument('--jitter', help='Link jitter, in seconds.', type=float, default=c.LINK_JITTER)
+    parser.add_argument('--jitter-dist', help='Link jitter distribution.', choices=list(JITTER),
+                        default=c.LINK_JITTER_DIST)
+    parser.add_argument('--bandwidth', help='Link rate, in bits per second.', type=float, default=c.LINK_BANDWIDTH)
+    parser.add_argument('--queue', help='Link queue size, in packets.', type=int, default=c.LINK_QUEUE)
+    parser.add_argument('--queue-policy', help='Link queue policy.', choices=['droptail', 'red'],
+                        default=c.LINK_QUEUE_POLICY)
+    parser.add_argument('--compression', help='Payload compression.', choices=['none', 'zlib', 'zlib-stream'],
+                        default='none')
+    parser.add_argument('--level', help='Compression level.', type=int, default=c.COMPRESSION_LEVEL)
+    parser.add_argument('--file', help='Transfers the content of a file instead of generated data.')
+    args = parser.parse_args()
+    link = {
+        'delay': args.delay, 'jitter': args.jitter, 'jitter_dist': args.jitter_dist,
+        'bandwidth': args.bandwidth, 'queue_size': args.queue, 'queue': args.queue_policy,
+    }
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    else:
+        data = bytes(ord('a') + i % 26 for i in range(args.size))
+    stats = run_transfer(
+        data, args.seed, args.loss, args.corruption, args.reorder,
+        ws=args.window, congestion=args.congestion, link=link,
+        compression=args.compression, level=args.level
+    )
+    if not stats['ok']:
+        sys.exit('ERROR: data received does not match data sent')
+
+    print(f"Transferred {len(data)} bytes in {stats['elapsed_time']:.3f}s")
+    print(f"Goodput: {stats['goodput']:.2f} bps")
+    print(f"Data pkts: {stats['pkts_sent']}, retransmissions: {stats['retransmissions']} "
+          f"(fast: {stats['fast_retransmissions']}), corrupted: {stats['corrupted_pkts']}, "
+          f"link drops: {stats['link_drops']}")
+    if args.compression != 'none':
+        print(f"Compressed {stats['uncompressed_bytes']} bytes to {stats['compressed_bytes']}")
@@ -0,0 +1,143 @@
+import sys, argparse, csv, json
+from itertools import product
+from threading import Thread
+from time import sleep
+
+# Hacky fix to import from parent folder
+path_slip = __file__.split('/')
+sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
+
+from Network import NetworkLayer
+from loopback import run_transfer
+import constants as c
+
+# Parameters swept, in the order they are varied, with the command line option
+# and type of each one
+PARAMS = [
+    ('size', int, [256 * 1024]),
+    ('window', int, [c.WINDOW_SIZE]),
+    ('packet_size', int, [c.PACKET_SIZE]),
+    ('timeout', float, [c.TIMEOUT]),
+    ('loss', float, [0.0]),
+    ('corruption', float, [0.0]),
+    ('reorder', float, [0.0]),
+]
+# Metrics summarized over the trials of each configuration
+METRICS = ['goodput', 'elapsed_time', 'retransmissions']
+PERCENTILES = [10, 50, 90]
+
+# Linear interpolation between the closest ranks
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    pos = (len(values) - 1) * p / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+# Network layers of a transfer over real TCP sockets of this host. Faults are
+# class attributes of NetworkLayer, so they apply to both directions
+def socket_conns(port: int, loss: float, corruption: float, reorder: float) -> tuple:
+    NetworkLayer.prob_pkt_loss = loss
+    NetworkLayer.prob_byte_corr = corruption
+    NetworkLayer.prob_pkt_reorder = reorder
+
+    server = []
+    accept = Thread(target=lambda: server.append(NetworkLayer('server', 'localhost', port)))
+    accept.start()
+    for _ in range(50):
+        try:
+            client = NetworkLayer('client', 'localhost', port)
+            break
+        except ConnectionRefusedError:
+            sleep(0.02)
+    else:
+        raise RuntimeError(f'Could not connect to port {port}')
+    accept.join()
+    return client, server[0]
+
+def run_config(config: dict, trials: int, seed: int, backend: str, port: int) -> dict:
+    data = bytes(ord('a') + i % 26 for i in range(config['size']))
+    results = []
+    for trial in range(trials):
+        conns = None
+        if backend == 'socket':
+            conns = socket_conns(port + trial, config['loss'], config['corruption'], config['reorder'])
+        stats = run_transfer(
+            data, seed + trial, config['loss'], config['corruption'], config['reorder'],
+            ws=config['window'], timeout_sec=config['timeout'], packet_size=config['packet_size'],
+            conns=conns
+        )
+        if not stats['ok']:
+            raise RuntimeError(f'Data received does not match data sent: {config}')
+        results.append(stats)
+
+    row = {**config, 'trials': trials}
+    for metric in METRICS:
+        values = [r[metric] for r in results]
+        for p in PERCENTILES:
+            row[f'{metric}_p{p}'] = percentile(values, p)
+    return row
+
+def config_key(row: dict) -> tuple:
+    return tuple(row[name] for name, _, _ in PARAMS)
+
+# Configurations whose median goodput dropped more than tolerance (a fraction)
+# below the baseline's
+def find_regressions(rows: list, baseline: list, tolerance: float) -> list:
+    reference = {config_key(row): row for row in baseline}
+    regressions = []
+    for row in rows:
+        base = reference.get(config_key(row))
+        if base is None:
+            continue
+        if row['goodput_p50'] < base['goodput_p50'] * (1 - tolerance):
+            regressions.append((row, base))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Selective repeat parameter sweep.')
+    for name, type_, default in PARAMS:
+        parser.add_argument('--' + name.replace('_', '-'), help=f'Values of {name} swept.',
+                            type=type_, nargs='+', default=default)
+    parser.add_argument('--trials', help='Trials of each configuration.', type=int, default=5)
+    parser.add_argument('--seed', help='Seed of the first trial, the next ones add one.', type=int, default=0)
+    parser.add_argument('--backend', help='In-memory channel or TCP sockets.',
+                        choices=['loopback', 'socket'], default='loopback')
+    parser.add_argument('--port', help='First port of the socket backend.', type=int, default=9500)
+    parser.add_argument('--csv', help='Writes the results to a CSV file.')
+    parser.add_argument('--json', help='Writes the results to a JSON file.')
+    parser.add_argument('--baseline', help='JSON results to compare against.')
+    parser.add_argument('--tolerance', help='Goodput drop flagged as a regression.', type=float, default=0.1)
+    args = parser.parse_args()
+
+    names = [name for name, _, _ in PARAMS]
+    grid = list(product(*[getattr(args, name) for name in names]))
+    rows = []
+    for i, values in enumerate(grid):
+        config = dict(zip(names, values))
+        row = run_config(config, args.trials, args.seed, args.backend, args.port + i * args.trials)
+        rows.append(row)
+        print(f"[{i + 1}/{len(grid)}] {config}: goodput median {row['goodput_p50']:.0f} bps "
+              f"(p10 {row['goodput_p10']:.0f}, p90 {row['goodput_p90']:.0f}), "
+              f"retransmissions median {row['retransmissions_p50']:.0f}")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(rows, baseline, args.tolerance)
+        for row, base in regressions:
+            print(f"REGRESSION {dict((name, row[name]) for name in names)}: goodput median "
+                  f"{row['goodput_p50']:.0f} bps, baseline {base['goodput_p50']:.0f} bps")
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline')
@@ -0,0 +1,67 @@
+import hashlib
+import struct
+import zlib
+
+class Checksum:
+    # identifier carried in the frame header, so both ends can check they agree
+    id = 0
+    name = None
+    # digest length in bytes
+    size = 0
+
+    def compute(self, *chunks) -> bytes:
+        raise NotImplementedError
+
+    def hexsize(self):
+        return self.size * 2
+
+
+class CRC32(Checksum):
+    id = 1
+    name = 'crc32'
+    size = 4
+    _pack = struct.Struct('!I').pack
+
+    def compute(self, *chunks) -> bytes:
+        value = 0
+        for chunk in chunks:
+            value = zlib.crc32(chunk, value)
+        return self._pack(value)
+
+
+class Adler32(Checksum):
+    id = 2
+    name = 'adler32'
+    size = 4
+    _pack = struct.Struct('!I').pack
+
+    def compute(self, *chunks) -> bytes:
+        value = 1
+        for chunk in chunks:
+            value = zlib.adler32(chunk, value)
+        return self._pack(value)
+
+
+# Kept for compatibility with the original text wire format
+class MD5(Checksum):
+    id = 3
+    name = 'md5'
+    size = 16
+
+    def compute(self, *chunks) -> bytes:
+        digest = hashlib.md5()
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.digest()
+
+
+CHECKSUMS = {
+    CRC32.name: CRC32,
+    Adler32.name: Adler32,
+    MD5.name: MD5,
+}
+
+def get_checksum(name: str) -> Checksum:
+    if name not in CHECKSUMS:
+        raise ValueError(f'Unknown checksum: {name}')
+    return CHECKSUMS[name]()
@@ -0,0 +1,136 @@
+import zlib
+
+# First byte of every payload once compression is on
+RAW = b'\x00'
+DEFLATE = b'\x01'
+# Tail of a deflate sync flush, left out of the payload and added back on inflate
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+class Compression:
+    """No compression, payloads are sent as they are, with no marker byte.
+
+    An instance is used by one end of one direction of a connection: the
+    sender's compresses payloads in seq order and the receiver's decompresses
+    them in the same order. Stats count data as given by and to the layer above
+    (uncompressed) and as carried in packets (compressed).
+    """
+    name = 'none'
+
+    def __init__(self, level=6):
+        self.level = level
+        # Stats variables
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+    def compress(self, data: bytes) -> bytes:
+        self.uncompressed_bytes += len(data)
+        self.compressed_bytes += len(data)
+        return data
+
+    def decompress(self, payload: bytes) -> bytes:
+        self.uncompressed_bytes += len(payload)
+        self.compressed_bytes += len(payload)
+        return payload
+
+    def get_stats(self):
+        return {
+            'compression': self.name,
+            'uncompressed_bytes': self.uncompressed_bytes,
+            'compressed_bytes': self.compressed_bytes,
+        }
+
+
+class Zlib(Compression):
+    """Every packet deflated on its own, so it can be inflated in any order.
+
+    A packet that doesn't shrink below max_ratio of its size is sent raw, and
+    so are the next skip_packets ones without trying, so data that doesn't
+    compress costs little CPU.
+    """
+    name = 'zlib'
+    max_ratio = 0.95
+    skip_packets = 16
+    # Whether the deflate state carries over packets. If so, data deflated has
+    # to be sent deflated even if it didn't shrink
+    stateful = False
+
+    def __init__(self, level=6):
+        super().__init__(level)
+        self.skipping = 0
+
+    def _deflate(self, data: bytes) -> bytes:
+        deflater = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return deflater.compress(data) + deflater.flush()
+
+    def _inflate(self, data: bytes) -> bytes:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        self.uncompressed_bytes += len(data)
+        if self.skipping:
+            self.skipping -= 1
+            payload = RAW + data
+        else:
+            deflated = self._deflate(data)
+            shrunk = len(deflated) < len(data) * self.max_ratio
+            if not shrunk:
+                self.skipping = self.skip_packets
+            payload = DEFLATE + deflated if shrunk or self.stateful else RAW + data
+        self.compressed_bytes += len(payload)
+        return payload
+
+    def decompress(self, payload: bytes) -> bytes:
+        self.compressed_bytes += len(payload)
+        data = self._inflate(payload[1:]) if payload[:1] == DEFLATE else payload[1:]
+        self.uncompressed_bytes += len(data)
+        return data
+
+
+class ZlibStream(Zlib):
+    """Packets deflated over one context per direction, so later packets
+    reference data of earlier ones and small packets compress much better.
+
+    Each packet is sync flushed, so it inflates on its own once every packet
+    before it was inflated, which the receiver does as it delivers in order.
+    """
+    name = 'zlib-stream'
+    stateful = True
+
+    def __init__(self, level=6):
+        super().__init__(level)
+        self.deflater = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def _deflate(self, data: bytes) -> bytes:
+        deflated = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        return deflated[:-len(SYNC_TAIL)]
+
+    def _inflate(self, data: bytes) -> bytes:
+        return self.inflater.decompress(data + SYNC_TAIL)
+
+
+COMPRESSORS = {
+    Compression.name: Compression,
+    Zlib.name: Zlib,
+    ZlibStream.name: ZlibStream,
+}
+
+# zlib levels, -1 being its default
+LEVELS = (-1, *range(1, 10))
+
+def get_compressor(name: str, level=6) -> Compression:
+    if name not in COMPRESSORS:
+        raise ValueError(f'Unknown compression: {name}')
+    if type(level) is not int or level not in LEVELS:
+        raise ValueError(f'Invalid compression level: {level}')
+    return COMPRESSORS[name](level)
+
+# Compression answered to an offer "<name> <level>", as (name, level): the one
+# offered if its name and level are valid, none otherwise
+def accept_offer(offer: bytes) -> tuple:
+    try:
+        name, level = offer.decode('utf-8').split(' ')
+        get_compressor(name, int(level))
+        return name, int(level)
+    except ValueError:
+        return Compression.name, 6
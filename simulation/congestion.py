@@ -0,0 +1,133 @@
+class CongestionController:
+    """Base class of the controllers deciding how many packets can be in-air.
+
+    The sender reports every ACKed packet and every loss, and reads the
+    resulting window before sending. Windows are counted in packets.
+    """
+    name = None
+
+    def __init__(self, initial_window=2, ssthresh=64):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(ssthresh)
+        # upper bound set by the sender, from its sequence number space
+        self.max_window = None
+        # losses of packets sent before the last window reduction are ignored,
+        # so one bad RTT only shrinks the window once
+        self.recovery_time = 0
+
+    def window(self) -> int:
+        window = max(1, int(self.cwnd))
+        if self.max_window is not None:
+            window = min(window, self.max_window)
+        return window
+
+    def on_ack(self, acked: int, rtt: float=None):
+        pass
+
+    # Packet sent at sent_time timed out
+    def on_timeout(self, sent_time: float, now: float):
+        pass
+
+    # Loss inferred from later packets being ACKed, the path is still delivering
+    def on_loss(self, sent_time: float, now: float):
+        pass
+
+    def _clamp(self):
+        if self.max_window is not None:
+            self.cwnd = min(self.cwnd, self.max_window)
+
+    def get_stats(self):
+        return {
+            'controller': self.name,
+            'cwnd': self.cwnd,
+            'ssthresh': self.ssthresh,
+        }
+
+
+# Fixed window, only limited by the sequence number space
+class FixedWindow(CongestionController):
+    name = 'fixed'
+
+    def window(self) -> int:
+        return self.max_window if self.max_window is not None else max(1, int(self.cwnd))
+
+    def get_stats(self):
+        return {
+            'controller': self.name,
+            'cwnd': self.window(),
+            'ssthresh': None,
+        }
+
+
+# AIMD with slow start and congestion avoidance, as TCP Reno
+class Reno(CongestionController):
+    name = 'reno'
+
+    def on_ack(self, acked: int, rtt: float=None):
+        for _ in range(acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self._clamp()
+
+    def on_timeout(self, sent_time: float, now: float):
+        if sent_time < self.recovery_time:
+            return
+        self.recovery_time = now
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1
+
+    def on_loss(self, sent_time: float, now: float):
+        if sent_time < self.recovery_time:
+            return
+        self.recovery_time = now
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+
+
+# Delay based controller, as TCP Vegas. Compares the expected rate (window over
+# the minimum RTT seen) with the actual one, and keeps between alpha and beta
+# packets queued in the path. Losses are handled as in Reno.
+class Vegas(Reno):
+    name = 'vegas'
+    alpha = 2
+    beta = 4
+
+    def __init__(self, initial_window=2, ssthresh=64):
+        super().__init__(initial_window, ssthresh)
+        self.base_rtt = None
+
+    def on_ack(self, acked: int, rtt: float=None):
+        if rtt is None:
+            return super().on_ack(acked)
+        if self.base_rtt is None or rtt < self.base_rtt:
+            self.base_rtt = rtt
+
+        # estimated number of packets queued along the path
+        queued = self.cwnd * (1 - self.base_rtt / rtt) if rtt > 0 else 0
+        for _ in range(acked):
+            if queued < self.alpha:
+                self.cwnd += 1 if self.cwnd < self.ssthresh else 1 / self.cwnd
+            elif queued > self.beta:
+                self.ssthresh = min(self.ssthresh, self.cwnd)
+                self.cwnd = max(2, self.cwnd - 1 / self.cwnd)
+        self._clamp()
+
+    def get_stats(self):
+        return {
+            **super().get_stats(),
+            'base_rtt': self.base_rtt,
+        }
+
+
+CONTROLLERS = {
+    FixedWindow.name: FixedWindow,
+    Reno.name: Reno,
+    Vegas.name: Vegas,
+}
+
+def get_controller(name: str) -> CongestionController:
+    if name not in CONTROLLERS:
+        raise ValueError(f'Unknown congestion controller: {name}')
+    return CONTROLLERS[name]()
@@ -1,4 +1,18 @@
-WINDOW_SIZE = 20
+WINDOW_SIZE = 20  # max packets in-air, independent from the 32-bit seq numbers
 TIMEOUT = 1.5
 PACKET_SIZE = 512
+TRANSPORT = 'tcp'  # network layer: "tcp" stream or "udp" datagrams
+CODEC = 'binary'  # wire format: "text" or "binary"
+CHECKSUM = 'crc32'  # frame checksum: "crc32", "adler32" or "md5"
+CONGESTION = 'reno'  # congestion control: "fixed", "reno" or "vegas"
+DELAYED_ACK_PKTS = 2  # in-order packets ACKed together
+DELAYED_ACK_TIMEOUT = 0.04  # max seconds an in-order packet waits for its ACK
+LINK_DELAY = 0  # one-way propagation delay of the emulated link, in seconds
+LINK_JITTER = 0  # extra random delay, in seconds
+LINK_JITTER_DIST = 'uniform'  # jitter distribution: "uniform", "normal" or "exponential"
+LINK_BANDWIDTH = None  # bottleneck rate in bits per second, None for no limit
+LINK_QUEUE = None  # bottleneck queue size in packets, None for unbounded
+LINK_QUEUE_POLICY = 'droptail'  # queue management: "droptail" or "red"
+COMPRESSION = 'none'  # payload compression offered by the client: "none", "zlib" or "zlib-stream"
+COMPRESSION_LEVEL = 6  # zlib level, from 1 (fastest) to 9 (smallest)
 DEBUG = False
\ No newline at end of file
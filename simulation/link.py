@@ -0,0 +1,199 @@
+import sys
+import heapq
+import random
+import threading
+import traceback
+from collections import deque
+from itertools import count
+from time import monotonic
+
+# Jitter distributions, each one returning the extra delay of a frame from the
+# link's generator and jitter parameter
+JITTER = {
+    # between 0 and jitter
+    'uniform': lambda rng, jitter: rng.uniform(0, jitter),
+    # half-normal with jitter as standard deviation
+    'normal': lambda rng, jitter: abs(rng.gauss(0, jitter)),
+    # exponential with jitter as mean, a long tail of late frames
+    'exponential': lambda rng, jitter: rng.expovariate(1 / jitter),
+}
+
+QUEUES = ('droptail', 'red')
+
+class Link:
+    """One direction of an emulated link, delivering frames at the time they
+    would arrive on a real one.
+
+    Frames wait in a bottleneck queue to be serialized at `bandwidth` bits per
+    second, then take `delay` seconds plus a jitter sample to arrive. The queue
+    holds at most `queue_size` frames, and frames arriving to a full queue are
+    dropped (drop-tail), or dropped early with a probability growing with the
+    average queue length (RED). Frames are delivered in order by a thread of the
+    link, calling the deliver function given with each of them.
+    """
+
+    # RED parameters, thresholds are fractions of queue_size
+    red_min = 0.25
+    red_max = 0.75
+    red_max_p = 0.1
+    red_weight = 0.002
+
+    def __init__(
+        self,
+        delay=0, jitter=0, jitter_dist='uniform',
+        bandwidth=None, queue_size=None, queue='droptail',
+        seed=None
+    ):
+        if jitter_dist not in JITTER:
+            raise ValueError(f'Unknown jitter distribution: {jitter_dist}')
+        if queue not in QUEUES:
+            raise ValueError(f'Unknown queue policy: {queue}')
+        self.delay = delay
+        self.jitter = jitter
+        self.jitter_dist = JITTER[jitter_dist]
+        self.bandwidth = bandwidth
+        self.queue_size = queue_size
+        self.queue = queue
+        self.rng = random.Random(seed)
+
+        # time the last frame accepted is fully serialized
+        self.free_at = 0
+        # serialization end of every frame in the queue, the one being sent included
+        self.departures = deque()
+        self.last_arrival = 0
+        self.avg_queue = 0
+        # frames accepted since the last RED drop
+        self.red_count = -1
+        # frames in flight, heap of (arrival time, order, frame, deliver)
+        self.pending = []
+        self.order = count()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+        self.running = False
+        self.closed = False
+        # Stats variables
+        self.delivered = 0
+        self.queue_drops = 0
+        self.red_drops = 0
+        self.max_queue = 0
+
+    # Without delay or bandwidth limit frames are delivered right away
+    def passthrough(self) -> bool:
+        return not self.delay and not self.jitter and not self.bandwidth
+
+    ## Sends a frame of size bytes (len(frame) if None) over the link. Returns
+    ## False if the queue dropped it
+    def transmit(self, frame: bytes, deliver, size: int=None) -> bool:
+        if self.passthrough():
+            self.delivered += 1
+            deliver(frame)
+            return True
+
+        size = len(frame) if size is None else size
+        with self.lock:
+            if self.closed:
+                return False
+            now = monotonic()
+            if self._drop(now):
+                return False
+            start = max(now, self.free_at)
+            self.free_at = start + (size * 8 / self.bandwidth if self.bandwidth else 0)
+            self.departures.append(self.free_at)
+
+            arrival = self.free_at + self.delay
+            if self.jitter:
+                arrival += self.jitter_dist(self.rng, self.jitter)
+            # a link doesn't reorder, late frames hold back the ones after them
+            arrival = max(arrival, self.last_arrival)
+            self.last_arrival = arrival
+
+            heapq.heappush(self.pending, (arrival, next(self.order), frame, deliver))
+            if not self.running:
+                self._start()
+            self.changed.notify()
+        return True
+
+    # Queue management, called with lock held
+    def _drop(self, now: float) -> bool:
+        while self.departures and self.departures[0] <= now:
+            self.departures.popleft()
+        length = len(self.departures)
+        self.max_queue = max(self.max_queue, length)
+        if self.queue_size is None:
+            return False
+
+        if self.queue == 'red':
+            self.avg_queue = (1 - self.red_weight) * self.avg_queue + self.red_weight * length
+        if length >= self.queue_size:
+            self.queue_drops += 1
+            return True
+        if self.queue != 'red':
+            return False
+
+        min_th = self.red_min * self.queue_size
+        max_th = self.red_max * self.queue_size
+        if self.avg_queue < min_th:
+            self.red_count = -1
+            return False
+        self.red_count += 1
+        if self.avg_queue >= max_th:
+            p = 1
+        else:
+            p = self.red_max_p * (self.avg_queue - min_th) / (max_th - min_th)
+            # spreads the drops evenly instead of in bursts
+            p = p / (1 - self.red_count * p) if self.red_count * p < 1 else 1
+        if self.rng.random() < p:
+            self.red_count = 0
+            self.red_drops += 1
+            return True
+        return False
+
+    def _start(self):
+        self.running = True
+        self.thread = threading.Thread(name='Link', target=self._run, daemon=True)
+        self.thread.start()
+
+    # Frames still in flight are lost
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.closed = True
+            self.pending = []
+            self.changed.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.running and not self.pending:
+                    self.changed.wait()
+                if not self.running:
+                    return
+                delay = self.pending[0][0] - monotonic()
+                if delay > 0:
+                    self.changed.wait(delay)
+                    continue
+                now = monotonic()
+                due = []
+                while self.pending and self.pending[0][0] <= now:
+                    due.append(heapq.heappop(self.pending))
+                self.delivered += len(due)
+
+            # Delivered outside the lock, so the receiving end can send back
+            for _, _, frame, deliver in due:
+                try:
+                    deliver(frame)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'delivered': self.delivered,
+                'queue_drops': self.queue_drops,
+                'red_drops': self.red_drops,
+                'max_queue': self.max_queue,
+            }
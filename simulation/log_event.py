@@ -1,4 +1,7 @@
 import json
+import struct
+import threading
+from collections import deque
 from time import time_ns
 
 # Event types
@@ -11,29 +14,141 @@ DUP_DATA     = 6
 OUT_OF_ORDER = 7
 ACK_RECV     = 8
 DATA_RECV    = 9
+FAST_RETX    = 10
 
 class Event:
-    def __init__(self, type, seq, base, data):
+    # Only the payload size is kept, unless the logger is asked for the data
+    __slots__ = ('type', 'seq', 'base', 'size', 'time', 'data')
+
+    def __init__(self, type, seq, base, size, time, data=None):
         self.type = type
-        self.data = data
         self.seq  = seq
         self.base = base
-        self.time = time_ns()
+        self.size = size
+        self.time = time
+        self.data = data
 
     def export(self):
-        return {
+        event = {
             'type': self.type,
             'time': self.time,
             'base': self.base,
             'seq' : self.seq,
-            'data': self.data,
+            'size': self.size,
         }
+        if self.data is not None:
+            event['data'] = self.data
+        return event
+
+
+# Binary trace: the magic and one fixed size record per event
+TRACE_MAGIC = b'RDTTRACE\x01'
+TRACE_RECORD = struct.Struct('<BqIII')  # type, time (ns), base, seq, size
+TRACE_FORMATS = ('jsonl', 'binary')
+
+class TraceWriter:
+    """Streams events to a trace file from a background thread.
+
+    Events are queued by the threads marking them and written in batches every
+    flush_interval seconds, so logging never waits on the file.
+    """
+
+    def __init__(self, path: str, fmt='jsonl', flush_interval=0.5):
+        if fmt not in TRACE_FORMATS:
+            raise ValueError(f'Unknown trace format: {fmt}')
+        self.fmt = fmt
+        self.file = open(path, 'wb')
+        if fmt == 'binary':
+            self.file.write(TRACE_MAGIC)
+        self.flush_interval = flush_interval
+        # (type, time, base, seq, size) tuples not written yet
+        self.queue = deque()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(name='TraceWriter', target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, record: tuple):
+        self.queue.append(record)
+
+    def _flush(self):
+        records = []
+        while self.queue:
+            records.append(self.queue.popleft())
+        if not records:
+            return
+        if self.fmt == 'binary':
+            data = b''.join(TRACE_RECORD.pack(*r) for r in records)
+        else:
+            data = ''.join(
+                f'{{"type": {r[0]}, "time": {r[1]}, "base": {r[2]}, "seq": {r[3]}, "size": {r[4]}}}\n'
+                for r in records
+            ).encode('utf-8')
+        self.file.write(data)
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self._flush()
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self._flush()
+        self.file.close()
+
+
+## Reads back the events of a trace file, in either format, as dicts
+def read_trace(path: str):
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) == TRACE_MAGIC:
+            fields = ('type', 'time', 'base', 'seq', 'size')
+            for record in TRACE_RECORD.iter_unpack(f.read()):
+                yield dict(zip(fields, record))
+            return
+        f.seek(0)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
 
 class Logger:
-    events = []
+    """Event log of a connection.
 
-    def __init__(self):
-        pass
+    Events are kept in memory as compact Event objects, every one of them
+    (capacity None), only the latest `capacity` ones, or none (capacity 0). Only
+    one of every `sample_every` events is kept and traced, but the first and
+    last event times are always tracked. With a trace path, events are also
+    streamed to a JSONL or binary file; call close to flush it.
+    """
+
+    def __init__(self, capacity: int=None, sample_every=1, trace: str=None, trace_format='jsonl', keep_data=False):
+        self.events = [] if capacity is None else deque(maxlen=capacity)
+        self.sample_every = sample_every
+        self.keep_data = keep_data
+        self.count = 0
+        self.first_time = None
+        self.last_time = None
+        self.writer = TraceWriter(trace, trace_format) if trace else None
 
     def mark_event(self, type, base=0, seq=0, data=''):
-        self.events.append(Event(type, seq, base, data))
+        now = time_ns()
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.count += 1
+        if self.sample_every > 1 and self.count % self.sample_every:
+            return
+
+        size = len(data) if data else 0
+        self.events.append(Event(type, seq, base, size, now, data if self.keep_data else None))
+        if self.writer: self.writer.write((type, now, base, seq, size))
+
+    # Nanoseconds from the first to the last event marked
+    def elapsed_ns(self) -> int:
+        if self.first_time is None:
+            return 0
+        return self.last_time - self.first_time
+
+    def close(self):
+        if self.writer: self.writer.close()
@@ -0,0 +1,40 @@
+class RttEstimator:
+    """Retransmission timeout estimation, as described in RFC 6298.
+
+    Keeps a smoothed RTT and its variance from the samples given to it. Samples
+    from retransmitted packets must not be given (Karn's algorithm), since their
+    ACK can't be matched to a single transmission.
+    """
+    alpha = 1/8
+    beta = 1/4
+    k = 4
+    # clock granularity, the resolution of the timer wheel
+    granularity = 0.01
+    # The RFC asks for a 1 second minimum, which is far too long for loopback
+    # and LAN paths. Uses the same floor as Linux instead
+    min_rto = 0.2
+    max_rto = 60
+    # maximum number of times a timeout is doubled
+    max_backoff = 6
+
+    def __init__(self, initial_rto=1.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.samples = 0
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.samples += 1
+        rto = self.srtt + max(self.granularity, self.k * self.rttvar)
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    # Timeout for a packet that already timed out `retries` times, doubled on
+    # each of them
+    def timeout(self, retries=0) -> float:
+        return min(self.rto * 2 ** min(retries, self.max_backoff), self.max_rto)
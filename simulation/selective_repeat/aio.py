@@ -0,0 +1,467 @@
+import sys, argparse, asyncio
+from typing import Awaitable, Callable
+from time import time, monotonic
+from sender import Sender
+from receiver import Receiver
+
+# Hacky fix to import from parent folder
+path_slip = __file__.split('/')
+sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
+
+from Network import FaultInjection, HEADER_TCP_IP, HEADER_UDP_IP
+from RDT import get_codec, CONTROL_STREAM
+from congestion import get_controller
+from compression import get_compressor, accept_offer
+from log_event import Logger, CORRUPT
+from utils import debug_log
+import constants as c
+import utils
+
+# Scheduler for AsyncTimer running the timers on the event loop, in place of the
+# timer wheel thread
+class LoopScheduler:
+    def __init__(self, loop: asyncio.AbstractEventLoop=None):
+        self.loop = loop or asyncio.get_running_loop()
+
+    def schedule(self, delay: float, callback, args=()) -> asyncio.TimerHandle:
+        return self.loop.call_later(delay, callback, *args)
+
+    def cancel(self, handle: asyncio.TimerHandle):
+        handle.cancel()
+
+
+## Network layer over an asyncio transport. Same udt_send and fault injection as
+## NetworkLayer, but received data is pushed to on_data as it arrives instead of
+## being collected by a thread
+class AsyncNetworkLayer(FaultInjection):
+    # Stats variables
+    bytes_sent = 0
+    bytes_recv = 0
+
+    def __init__(self, transport: asyncio.BaseTransport, kind='tcp', addr=None, peers: dict=None):
+        self.transport = transport
+        self.kind = kind
+        self.header_size = HEADER_TCP_IP if kind == 'tcp' else HEADER_UDP_IP
+        # Peer address, datagrams sent from a socket shared by many peers go to it
+        self.addr = addr
+        # Peers of the shared socket, the layer removes itself on disconnect
+        # instead of closing the socket
+        self.peers = peers
+        self.closed = False
+        # Called with the bytes received and when the connection is closed
+        self.on_data = None
+        self.on_close = None
+
+    def udt_send(self, msg_S):
+        if isinstance(msg_S, str):
+            msg_S = msg_S.encode('utf-8')
+        if self.closed:
+            return
+
+        for frame in self._inject_faults(msg_S):
+            if self.kind == 'udp':
+                self.transport.sendto(frame, self.addr)
+            else:
+                self.transport.write(frame)
+            self.bytes_sent += len(frame) + self.header_size
+
+    def data_received(self, data: bytes):
+        self.bytes_recv += len(data) + self.header_size
+        if self.on_data: self.on_data(data)
+
+    def connection_lost(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.on_close: self.on_close()
+
+    def disconnect(self):
+        if self.peers is not None:
+            self.peers.pop(self.addr, None)
+        else:
+            self.transport.close()
+        self.connection_lost()
+
+    def get_stats(self):
+        return {
+            'bytes_sent': self.bytes_sent,
+            'bytes_recv': self.bytes_recv,
+        }
+
+
+class _StreamProtocol(asyncio.Protocol):
+    def __init__(self, on_connect: Callable[[AsyncNetworkLayer], any]):
+        self.on_connect = on_connect
+        self.network = None
+
+    def connection_made(self, transport):
+        self.network = AsyncNetworkLayer(transport, 'tcp', transport.get_extra_info('peername'))
+        self.on_connect(self.network)
+
+    def data_received(self, data):
+        self.network.data_received(data)
+
+    def connection_lost(self, exc):
+        self.network.connection_lost()
+
+
+# Demultiplexes the datagrams of a socket by source address. A client socket is
+# connected, so it only has one peer
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_connect: Callable[[AsyncNetworkLayer], any], client=False):
+        self.on_connect = on_connect
+        self.client = client
+        self.transport = None
+        self.peers = dict()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.client:
+            network = AsyncNetworkLayer(transport, 'udp')
+            self.peers[None] = network
+            self.on_connect(network)
+
+    def datagram_received(self, data, addr):
+        key = None if self.client else addr
+        network = self.peers.get(key)
+        if network is None:
+            if self.client:
+                return
+            # There is no accept, the first datagram of a new address opens
+            # a session with it
+            debug_log(f'[aio]: New peer {addr}')
+            network = AsyncNetworkLayer(self.transport, 'udp', addr, self.peers)
+            self.peers[addr] = network
+            self.on_connect(network)
+        network.data_received(data)
+
+    def error_received(self, exc):
+        # the other end is not listening (yet), same as a lost packet
+        pass
+
+    def connection_lost(self, exc):
+        for network in list(self.peers.values()):
+            network.connection_lost()
+        self.peers.clear()
+
+
+class AsyncSender(Sender):
+    """Selective repeat sender driven by the event loop.
+
+    ACKs are handled in a callback scheduled once per batch, and senders waiting
+    for room in the window await an event instead of a condition, so no thread
+    is needed.
+    """
+
+    def __init__(self, conn: AsyncNetworkLayer, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.loop = asyncio.get_running_loop()
+        self.window_event = asyncio.Event()
+        self.drain_scheduled = False
+        self.running = True
+
+    # Sends data on stream 0 or one opened with open_stream, fin marking the
+    # last data of the stream. Streams are sent in the order send is called
+    async def send(self, data: bytes, stream: int=0, fin: bool=False):
+        while True:
+            if self.conn.closed or not self.running:
+                raise ConnectionResetError('RDT connection closed')
+            with self.control_lock:
+                if self._window_available():
+                    self._transmit(data, stream, fin)
+                    return
+                self.window_event.clear()
+            await self.window_event.wait()
+
+    # Waits until every packet sent is ACKed
+    async def drain(self):
+        while self.pending_packets() and self.running and not self.conn.closed:
+            self.window_event.clear()
+            await self.window_event.wait()
+
+    # ACKs of the same read are handled together, once the receiver is done
+    # with it
+    def notify_ack(self, seq: int, sack: list=()):
+        self.ack_queue.append((seq, sack))
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.loop.call_soon(self._handle_ack_batch)
+
+    def _handle_ack_batch(self):
+        self.drain_scheduled = False
+        acks = self._take_acks()
+        if acks and self.running:
+            self._handle_acks(acks)
+
+    def _wake_senders(self):
+        self.window_event.set()
+
+    def stop(self):
+        super().stop()
+        self.window_event.set()
+
+
+class AsyncReceiver(Receiver):
+    """Selective repeat receiver fed by the network layer callbacks.
+
+    Data of stream 0 delivered in order is queued for recv, and empty bytes mark
+    the end of the connection. The messages of other streams are queued whole,
+    as (stream, data), for recv_stream, and None marks the end.
+    """
+
+    def __init__(self, conn: AsyncNetworkLayer, sender_ack_notifier, **kwargs):
+        super().__init__(conn, sender_ack_notifier, **kwargs)
+        self.queue = asyncio.Queue()
+        self.streams = asyncio.Queue()
+        self.stream_callback = self._stream_message
+        self.eof = False
+        self.running = True
+        conn.on_data = self.feed
+        conn.on_close = self._close
+
+    def feed(self, data: bytes):
+        if not self.running:
+            return
+        self.last_recv_time = time()
+        pkts, corrupted = self.decoder.get_packets(data)
+        if corrupted:
+            self.corrupted_pkts += corrupted
+            if self.logger: self.logger.mark_event(CORRUPT)
+        for p in pkts:
+            self._recv(p, self.queue.put_nowait)
+
+    def _stream_message(self, stream: int, data: bytes):
+        self.streams.put_nowait((stream, data))
+
+    def _close(self):
+        self.queue.put_nowait(b'')
+        self.streams.put_nowait(None)
+
+    # Returns the next data received in order, or b'' once the connection is
+    # closed or after timeout seconds without data (forever if None)
+    async def recv(self, timeout: float=None) -> bytes:
+        if self.eof:
+            return b''
+        try:
+            data = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return b''
+        if not data:
+            self.eof = True
+        return data
+
+    # Returns the next message received on a stream other than 0, as
+    # (stream, data), or None once the connection is closed or after timeout
+    # seconds without one (forever if None)
+    async def recv_stream(self, timeout: float=None):
+        try:
+            message = await asyncio.wait_for(self.streams.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is None:
+            # Left for the next callers
+            self.streams.put_nowait(None)
+        return message
+
+    def stop(self):
+        super().stop()
+        self._close()
+
+
+class AsyncSession:
+    """Reliable connection over one AsyncNetworkLayer, pairing a sender and a
+    receiver that share the event loop instead of running threads."""
+
+    def __init__(
+        self,
+        network: AsyncNetworkLayer,
+        ws=c.WINDOW_SIZE, timeout_sec=c.TIMEOUT,
+        logger: Logger=None, codec=None, cc=None,
+        ack_every=c.DELAYED_ACK_PKTS, ack_delay=c.DELAYED_ACK_TIMEOUT,
+        packet_size=c.PACKET_SIZE
+    ):
+        self.network = network
+        self.packet_size = packet_size
+        codec = codec or get_codec(c.CODEC, c.CHECKSUM)
+        scheduler = LoopScheduler()
+        self.sender = AsyncSender(
+            network, ws=ws, timeout_sec=timeout_sec, logger=logger, codec=codec,
+            scheduler=scheduler, cc=cc or get_controller(c.CONGESTION)
+        )
+        self.recver = AsyncReceiver(
+            network, self.sender.notify_ack, ws=ws, logger=logger, codec=codec,
+            ack_every=ack_every, ack_delay=ack_delay, scheduler=scheduler
+        )
+        self.recver.stream_callback = self._stream_message
+        self.control_task = None
+        self.closed = False
+
+    # Control messages are handled by the session, never queued as data
+    def _stream_message(self, stream: int, data: bytes):
+        if stream == CONTROL_STREAM:
+            self._negotiate(data)
+            return
+        self.recver._stream_message(stream, data)
+
+    # Answers a compression offer like the threaded Server does. Called as the
+    # offer is delivered, so the packets after it are decompressed
+    def _negotiate(self, offer: bytes):
+        name, level = accept_offer(offer)
+        debug_log(f'[aio]: Compression offered: {offer}, using: {name}')
+        self.recver.set_compressor(get_compressor(name, level))
+        self.sender.set_compressor(get_compressor(name, level))
+        self.control_task = asyncio.ensure_future(
+            self.sender.send(f'{name} {level}'.encode('utf-8'), CONTROL_STREAM, fin=True)
+        )
+        self.control_task.add_done_callback(self._control_sent)
+
+    # Without the answer the peer doesn't know how the data is compressed, and
+    # stops waiting for it on its own
+    def _control_sent(self, task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            sys.stderr.write(f'Compression answer not sent: {task.exception()!r}\n')
+
+    # Sends data split in packets, waiting for room in the window. Data sent on
+    # a stream other than 0 is one message, delivered whole
+    async def send(self, data: bytes, stream: int=0):
+        chunks = utils.getChunks(self.packet_size, data)
+        if stream and not chunks:
+            chunks = [b'']
+        for i, chunk in enumerate(chunks):
+            await self.sender.send(chunk, stream, fin=stream != 0 and i == len(chunks) - 1)
+
+    async def recv(self, timeout: float=None) -> bytes:
+        return await self.recver.recv(timeout)
+
+    async def recv_stream(self, timeout: float=None):
+        return await self.recver.recv_stream(timeout)
+
+    async def drain(self):
+        await self.sender.drain()
+
+    # Waits up to timeout seconds for the data sent to be ACKed, then closes.
+    # A compression answer still waiting for room in the window is cancelled
+    async def close(self, timeout: float=None):
+        if self.closed:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            debug_log('[aio]: Closing with packets in-air')
+        self.closed = True
+        if self.control_task:
+            self.control_task.cancel()
+        self.sender.stop()
+        self.recver.stop()
+        self.network.disconnect()
+        if self.control_task:
+            await asyncio.gather(self.control_task, return_exceptions=True)
+
+    def get_stats(self):
+        return {
+            **self.network.get_stats(),
+            'sender': self.sender.get_stats(),
+            'recver': self.recver.get_stats(),
+        }
+
+
+async def open_connection(host: str, port: int, transport=c.TRANSPORT, **kwargs) -> AsyncSession:
+    loop = asyncio.get_running_loop()
+    connected = loop.create_future()
+
+    # The session is created as soon as the connection is, so no data arrives
+    # before its receiver is listening
+    def on_connect(network: AsyncNetworkLayer):
+        connected.set_result(AsyncSession(network, **kwargs))
+
+    if transport == 'tcp':
+        await loop.create_connection(lambda: _StreamProtocol(on_connect), host, port)
+    elif transport == 'udp':
+        await loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(on_connect, client=True), remote_addr=(host, port)
+        )
+    else:
+        raise ValueError(f'Unknown transport: {transport}')
+    return await connected
+
+
+## Serves every connection with handler(session) as a task of the loop. Returns
+## the asyncio server for tcp and the datagram transport for udp, both closed
+## with close()
+async def start_server(
+    host: str, port: int,
+    handler: Callable[[AsyncSession], Awaitable],
+    transport=c.TRANSPORT, **kwargs
+):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    def on_connect(network: AsyncNetworkLayer):
+        task = loop.create_task(handler(AsyncSession(network, **kwargs)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if transport == 'tcp':
+        return await loop.create_server(lambda: _StreamProtocol(on_connect), host, port)
+    elif transport == 'udp':
+        server, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(on_connect), local_addr=(host, port)
+        )
+        return server
+    raise ValueError(f'Unknown transport: {transport}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent selective repeat sessions on one event loop.')
+    parser.add_argument('server', help='Server.')
+    parser.add_argument('port', help='Port.', type=int)
+    parser.add_argument('--sessions', help='Number of concurrent sessions.', type=int, default=200)
+    parser.add_argument('--size', help='Bytes echoed by each session.', type=int, default=20000)
+    parser.add_argument('--transport', help='Transport.', choices=['tcp', 'udp'], default=c.TRANSPORT)
+    parser.add_argument('--loss', help='Packet loss probability.', type=float, default=0)
+    args = parser.parse_args()
+
+    AsyncNetworkLayer.prob_pkt_loss = args.loss
+    # Without EOF on udp, the server closes a session once it goes idle
+    idle_timeout = c.TIMEOUT + 5
+
+    async def uppercase(session: AsyncSession):
+        while True:
+            data = await session.recv(timeout=idle_timeout)
+            if not data:
+                break
+            await session.send(data.upper())
+        await session.close(timeout=idle_timeout)
+
+    async def client(index: int) -> dict:
+        data = bytes(ord('a') + (index + i) % 26 for i in range(args.size))
+        session = await open_connection(args.server, args.port, transport=args.transport)
+        await session.send(data)
+        response = []
+        received = 0
+        while received < len(data):
+            chunk = await session.recv(timeout=idle_timeout)
+            if not chunk:
+                break
+            response.append(chunk)
+            received += len(chunk)
+        await session.close(timeout=idle_timeout)
+        if b''.join(response) != data.upper():
+            raise RuntimeError(f'Session {index} received wrong data')
+        return session.get_stats()
+
+    async def main():
+        server = await start_server(args.server, args.port, uppercase, transport=args.transport)
+        start = monotonic()
+        stats = await asyncio.gather(*[client(i) for i in range(args.sessions)])
+        elapsed_time = monotonic() - start
+        server.close()
+
+        goodput = sum(s['sender']['bytes_sent'] + s['recver']['bytes_recv'] for s in stats)
+        goodput = goodput*8/elapsed_time
+        sys.stderr.write(f"Sessions: {len(stats)}\n")
+        sys.stderr.write(f"Aggregate goodput: {goodput:.2f} bps\n")
+        sys.stderr.write(f"Total data retransmissions: {sum(s['sender']['retransmissions'] for s in stats)}\n")
+        sys.stderr.write(f"Total communication time: {elapsed_time:.3f}s\n")
+
+    asyncio.run(main())
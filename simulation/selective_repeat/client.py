@@ -1,5 +1,6 @@
-import sys, argparse
-from threading import Thread, Lock
+import sys, os, argparse, shutil, tempfile, traceback
+from threading import Thread, Condition
+from multiprocessing import Process, Queue
 from sender import Sender
 from receiver import Receiver
 from time import time
@@ -9,65 +10,179 @@ path_slip = __file__.split('/')
 sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
 
 from Network import NetworkLayer
+from link import Link
+from RDT import get_codec, CONTROL_STREAM
+from congestion import get_controller
+from compression import get_compressor
 from log_event import *
 import constants as c
 import utils
+from utils import write_stats
 
 class Client(Thread):
-    def __init__(self, server, port, data, logger: Logger=None):
+    # Max seconds request waits for its response
+    request_timeout = 30
+    # Max seconds negotiate waits for the compression answer
+    negotiate_timeout = 30
+
+    # data is bytes, or an iterable of chunks of at most PACKET_SIZE bytes read
+    # while they are sent. Each one of requests is sent on its own stream while
+    # data is sent, and its response time is kept in request_times. The
+    # response is written to output, stdout by default
+    def __init__(self, server, port, data, logger: Logger=None, requests: list=(), output=None):
         Thread.__init__(self)
         self.logger = logger
-        self.data_buffer = data
+        self.output = output or sys.stdout.buffer
+        self.data_chunks = utils.getChunks(c.PACKET_SIZE, data) if isinstance(data, (bytes, bytearray)) else data
         self.server = server
         self.port = port
+        self.requests = requests
+        self.request_times = []
+        self.failed_requests = 0
+        # Responses received on each stream, stream -> data
+        self.responses = dict()
+        self.responses_ready = Condition()
+        # Streams whose request timed out, their response is dropped if it comes
+        self.timed_out = set()
+        # Compression agreed with the server, as (name, level)
+        self.compression = ('none', c.COMPRESSION_LEVEL)
+        # Error the transfer was aborted with, None if it went through
+        self.error = None
+
+    # Sends data on a new stream and waits for the response on the same stream,
+    # up to timeout seconds (request_timeout if None)
+    def request(self, data: bytes, timeout: float=None) -> bytes:
+        timeout = self.request_timeout if timeout is None else timeout
+        stream = self.sender.open_stream()
+        self.sender.send_message(stream, utils.getChunks(c.PACKET_SIZE, data))
+        with self.responses_ready:
+            if not self.responses_ready.wait_for(lambda: stream in self.responses, timeout=timeout):
+                # The id is freed once the late response arrives, if it does
+                self.timed_out.add(stream)
+                raise TimeoutError(f'No response on stream {stream} after {timeout}s')
+            response = self.responses.pop(stream)
+        self.sender.close_stream(stream)
+        return response
+
+    # Offers compression to the server and waits for its answer, up to
+    # negotiate_timeout seconds. Both ends use the compression answered for
+    # everything sent after it. The server may switch as soon as it gets the
+    # offer, so without an answer there's no compression the data could be sent
+    # with, and TimeoutError is raised
+    def negotiate(self, name: str, level: int):
+        self.sender.send_message(CONTROL_STREAM, [f'{name} {level}'.encode('utf-8')])
+        with self.responses_ready:
+            if not self.responses_ready.wait_for(lambda: CONTROL_STREAM in self.responses,
+                                                 timeout=self.negotiate_timeout):
+                raise TimeoutError(f'No compression answer after {self.negotiate_timeout}s')
+            self.responses.pop(CONTROL_STREAM)
+        self.sender.set_compressor(get_compressor(*self.compression))
+
+    def _timed_request(self, data: bytes):
+        start = time()
+        try:
+            self.request(data)
+        except TimeoutError as err:
+            sys.stderr.write(f'Request failed: {err}\n')
+            with self.responses_ready:
+                self.failed_requests += 1
+            return
+        with self.responses_ready:
+            self.request_times.append(time() - start)
 
     def run(self):
         # Initialize state variables
-        global recv_buffer
-        recv_buffer = ''
-
-        # Mutex to control access to recv_buffer, since the recver and main threads
-        # will both access it simutaneously
-        buffer_mutex = Lock() 
-        self.conn = NetworkLayer('client', self.server, self.port)
-        self.sender = Sender(self.conn, ws=c.WINDOW_SIZE, timeout_sec=c.TIMEOUT, logger=self.logger)
-        self.recver = Receiver(self.conn, self.sender.notify_ack, ws=c.WINDOW_SIZE, logger=self.logger)
-
-        # Callback called by Receiver when data arrives
-        def recv_callback(msg: str):
-            global recv_buffer
+        bytes_sent = 0
+        bytes_recv = 0
+
+        # Mutex to control access to bytes_recv and stdout, since the recver and
+        # main threads will both access them simutaneously. Also signals the main
+        # thread when data arrives
+        buffer_mutex = Condition()
+        self.conn = NetworkLayer(
+            'client', self.server, self.port, transport=c.TRANSPORT,
+            link=Link(c.LINK_DELAY, c.LINK_JITTER, c.LINK_JITTER_DIST, c.LINK_BANDWIDTH, c.LINK_QUEUE, c.LINK_QUEUE_POLICY)
+        )
+        codec = get_codec(c.CODEC, c.CHECKSUM)
+        self.sender = Sender(
+            self.conn, ws=c.WINDOW_SIZE, timeout_sec=c.TIMEOUT, logger=self.logger, codec=codec,
+            cc=get_controller(c.CONGESTION)
+        )
+        self.recver = Receiver(
+            self.conn, self.sender.notify_ack, ws=c.WINDOW_SIZE, logger=self.logger, codec=codec,
+            ack_every=c.DELAYED_ACK_PKTS, ack_delay=c.DELAYED_ACK_TIMEOUT
+        )
+
+        # Callback called by Receiver when data arrives. The response is written
+        # out as it arrives, so nothing is buffered while the file is sent
+        def recv_callback(msg: bytes):
+            nonlocal bytes_recv
             with buffer_mutex:
-                recv_buffer += msg
+                self.output.write(msg)
+                bytes_recv += len(msg)
+                buffer_mutex.notify()
+
+        # Callback called by Receiver when the response of a request arrives.
+        # The answer to the compression offer is applied right away, before the
+        # packets after it are delivered
+        def stream_callback(stream: int, msg: bytes):
+            if stream == CONTROL_STREAM:
+                try:
+                    name, level = msg.decode('utf-8').split(' ')
+                    self.compression = (name, int(level))
+                    self.recver.set_compressor(get_compressor(*self.compression))
+                except ValueError:
+                    sys.stderr.write(f'Unexpected compression answer: {msg}\n')
+            with self.responses_ready:
+                if stream in self.timed_out:
+                    self.timed_out.discard(stream)
+                    self.sender.close_stream(stream)
+                    return
+                self.responses[stream] = msg
+                self.responses_ready.notify_all()
 
         # Runs sender and recver threads separately
         sender_t = Thread(target=self.sender.run)
-        recver_t = Thread(target=self.recver.run, args=[recv_callback])
+        recver_t = Thread(target=self.recver.run, args=[recv_callback, stream_callback])
         sender_t.start()
         recver_t.start()
+        if c.COMPRESSION != 'none':
+            try:
+                self.negotiate(c.COMPRESSION, c.COMPRESSION_LEVEL)
+            except TimeoutError as err:
+                self.error = err
+                self._shutdown([sender_t, recver_t])
+                return
+        request_ts = [Thread(target=self._timed_request, args=[req]) for req in self.requests]
+        for t in request_ts: t.start()
 
-        # Sends data in PACKET_SIZE sized chunks to server
-        bytes_pending = len(self.data_buffer)
-        for chunk in utils.getChunks(c.PACKET_SIZE, self.data_buffer):
+        # Sends data in PACKET_SIZE sized chunks to server. send blocks while the
+        # window is full, so chunks are only read as fast as they are ACKed
+        for chunk in self.data_chunks:
             self.sender.send(chunk)
-        
+            bytes_sent += len(chunk)
+
         # Waits for every byte in the response to be recved
-        while bytes_pending:
-            buffer_mutex.acquire()
-            bytes_pending -= len(recv_buffer)
-            sys.stdout.write(recv_buffer)
-            recv_buffer = ''
-            buffer_mutex.release()
+        with buffer_mutex:
+            buffer_mutex.wait_for(lambda: bytes_recv >= bytes_sent)
+        self.output.flush()
+        for t in request_ts: t.join()
 
         # Waits for no data to arrive for some time before closing connection to
-        # the server, in case ACK sent got lost
+        # the server, in case ACK sent got lost, unless the server closed it
         sys.stderr.write('Waiting a few seconds before closing connection with server\n')
         while time() < self.recver.last_recv_time + c.TIMEOUT + 5 :
-            pass
+            if self.recver.conn_closed.wait(max(0, self.recver.last_recv_time + c.TIMEOUT + 5 - time())):
+                break
+
+        self._shutdown([sender_t, recver_t])
 
+    # Stops the sender and receiver, waits for their threads and closes the
+    # connection
+    def _shutdown(self, threads: list):
         self.sender.stop()
         self.recver.stop()
-        sender_t.join()
-        recver_t.join()
+        for t in threads: t.join()
         self.conn.disconnect()
 
     def get_conn_stats(self):
@@ -81,26 +196,123 @@ class Client(Thread):
         }
 
 
+# Splits size bytes in `stripes` contiguous ranges of whole chunks, as
+# (offset, length)
+def stripe_ranges(size: int, stripes: int, chunk_size: int) -> list:
+    chunks = -(-size // chunk_size)
+    if chunks < stripes:
+        raise ValueError(f'{size} bytes can\'t be split in {stripes} stripes')
+    ranges = []
+    for i in range(stripes):
+        start = chunks * i // stripes * chunk_size
+        end = min(chunks * (i + 1) // stripes * chunk_size, size)
+        ranges.append((start, end - start))
+    return ranges
+
+# Sends one stripe from a process of its own, writing the response to
+# part_path, and puts its stats in results
+def _send_stripe(index: int, server: str, port: int, path: str, offset: int, length: int, part_path: str, results: Queue):
+    try:
+        logger = Logger(capacity=0)
+        with open(part_path, 'wb') as output:
+            data = utils.readChunks(path, c.PACKET_SIZE, offset=offset, length=length)
+            client = Client(server, port, data, logger, output=output)
+            client.start()
+            client.join()
+        logger.close()
+        if client.error:
+            raise client.error
+        stats = client.get_stats()
+        stats['start_time'] = (logger.first_time or 0) / 10**9
+        stats['end_time'] = (logger.last_time or 0) / 10**9
+        results.put((index, stats))
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        results.put((index, None))
+
+class StripedClient:
+    """Sends a file over `stripes` independent connections at the same time, so
+    a transfer isn't bound by one window per RTT or by one interpreter.
+
+    The file is split in contiguous ranges of whole packets and range i is sent
+    to port + i (see StripedServer) by a Client in a process of its own. Each
+    process writes its response to a part file, and the parts are written out
+    in order once every stripe is done.
+    """
+
+    def __init__(self, server: str, port: int, path: str, stripes: int):
+        self.server = server
+        self.port = port
+        self.path = path
+        self.stripes = stripes
+
+    # Sends the file, writes the response to output and returns the stats of
+    # every stripe, in stripe order
+    def run(self, output) -> list:
+        ranges = stripe_ranges(os.path.getsize(self.path), self.stripes, c.PACKET_SIZE)
+        results = Queue()
+        with tempfile.TemporaryDirectory() as parts_dir:
+            parts = [os.path.join(parts_dir, f'stripe{i}') for i in range(self.stripes)]
+            procs = [
+                Process(target=_send_stripe, args=[i, self.server, self.port + i, self.path, *ranges[i], parts[i], results])
+                for i in range(self.stripes)
+            ]
+            for p in procs: p.start()
+            # Taken before joining, a process doesn't exit until its results are read
+            stats = dict(results.get() for _ in procs)
+            for p in procs: p.join()
+            failed = [i for i, s in stats.items() if s is None]
+            if failed:
+                raise RuntimeError(f'Stripes failed: {failed}')
+
+            for part in parts:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, output)
+            output.flush()
+        return [stats[i] for i in range(self.stripes)]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Selective Repeat Client. Prints response to stdout')
     parser.add_argument('server', help='Server.')
     parser.add_argument('port', help='Port.', type=int)
     parser.add_argument('file', help='File.')
+    parser.add_argument('--trace', help='Streams the event log to a trace file.')
+    parser.add_argument('--trace-format', help='Trace file format.', choices=['jsonl', 'binary'], default='jsonl')
+    parser.add_argument('--requests', help='Small requests sent on their own streams during the transfer.',
+                        type=int, default=0)
+    parser.add_argument('--stripes', help='Sends the file over n connections, to ports port to port+n-1.',
+                        type=int, default=1)
     args = parser.parse_args()
+    if args.stripes > 1 and (args.requests or args.trace):
+        parser.error('--stripes can\'t be used with --requests or --trace')
 
+    if args.stripes > 1:
+        try:
+            stats = StripedClient(args.server, args.port, args.file, args.stripes).run(sys.stdout.buffer)
+        except (Exception, KeyboardInterrupt) as err:
+            sys.exit('ERROR: ' + type(err).__name__ + '\n' + str(err))
+        sys.stderr.write('\n')
+        for i, stripe in enumerate(stats):
+            write_stats(f'Stripe {i}', [stripe])
+        write_stats('Aggregate', stats)
+        sys.exit(0)
+
+    logger = None
     try:
-        data = []
-        with open(args.file) as f:
-            data = f.read()
+        # The file is streamed, never read whole
+        data = utils.readChunks(args.file, c.PACKET_SIZE)
 
-        client = Client(args.server, args.port, data, Logger())
+        requests = [f'request {i}'.encode('utf-8') for i in range(args.requests)]
+        logger = Logger(capacity=0, trace=args.trace, trace_format=args.trace_format)
+        client = Client(args.server, args.port, data, logger, requests=requests)
         client.start()
         client.join()
+        if client.error:
+            raise client.error
 
-        first_pkt_time = client.logger.events[0].export()['time']
-        last_pkt_time  = client.logger.events[-1].export()['time']
-
-        elapsed_time = (last_pkt_time - first_pkt_time)/10**9
+        client.logger.close()
+        elapsed_time = client.logger.elapsed_ns()/10**9
         stats = client.get_stats()
         throughput = stats['bytes_sent'] + stats['bytes_recv']
         throughput = throughput*8/elapsed_time
@@ -113,12 +325,28 @@ if __name__ == '__main__':
         sys.stderr.write(f"Total data pkts: {stats['sender']['pkts_sent']}\n")
         sys.stderr.write(f"Total ACK pkts: {stats['recver']['ack_pkts_sent']}\n")
         sys.stderr.write(f"Total data retransmissions: {stats['sender']['retransmissions']}\n")
+        sys.stderr.write(f"Total data fast retransmissions: {stats['sender']['fast_retransmissions']}\n")
         sys.stderr.write(f"Total ACK retransmissions: {stats['recver']['retransmissions']}\n")
         sys.stderr.write(f"Total corrupted pkts: {stats['recver']['corrupted_pkts']}\n")
+        sys.stderr.write(f"Total link queue drops: {stats['link']['queue_drops'] + stats['link']['red_drops']}\n")
+        sys.stderr.write(f"Final congestion window: {stats['sender']['cwnd']:.2f} ({stats['sender']['controller']})\n")
+        sys.stderr.write(f"Final retransmission timeout: {stats['sender']['rto']:.3f}s\n")
         sys.stderr.write(f"Total elapsed time: {elapsed_time}s\n")
+        if stats['sender']['compression'] != 'none':
+            sys.stderr.write(f"Compression ({stats['sender']['compression']}): "
+                             f"{stats['sender']['uncompressed_bytes']} bytes sent in {stats['sender']['compressed_bytes']}, "
+                             f"{stats['recver']['uncompressed_bytes']} bytes received in {stats['recver']['compressed_bytes']}\n")
+        if client.request_times:
+            times = sorted(client.request_times)
+            sys.stderr.write(f"Request time: median {times[len(times)//2]*1000:.1f} ms, max {times[-1]*1000:.1f} ms\n")
+        if client.failed_requests:
+            sys.stderr.write(f"Failed requests: {client.failed_requests}\n")
         
 
     except (Exception, KeyboardInterrupt) as err:
         sys.stderr.write('ERROR: ' + type(err).__name__ + '\n')
         sys.stderr.write(str(err))
         sys.stderr.write('\n')
+    finally:
+        # The trace keeps the events up to a failure
+        if logger: logger.close()
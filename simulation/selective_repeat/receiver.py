@@ -1,4 +1,5 @@
 import sys, argparse
+import threading
 from threading import Thread, Lock
 from typing import Callable
 from time import sleep, time
@@ -8,20 +9,26 @@ path_slip = __file__.split('/')
 sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
 
 from Network import NetworkLayer
-from RDT import Packet, getPackets, ACK
+from RDT import Packet, TextCodec, FrameDecoder, ACK, CONTROL_STREAM
 from utils import debug_log
+from seqnum import seq_add, seq_diff
+from async_timer import AsyncTimer
+from timer_wheel import TimerWheel
+from compression import Compression
 from log_event import *
 
 class Receiver:
     # State control variables
     base = 0
-    next_base = 0
     last_recv_time = 0
     running = False
-    status_lock = Lock()    # Lock for running status
-    control_lock = Lock()   # Lock for control variables
+    # Max time blocked waiting for data, only bounds how long stop takes
+    poll_timeout = 0.2
+    # Max SACK blocks carried by one ACK
+    max_sack_blocks = 16
     # Stats variables
-    bytes_recv = 0
+    bytes_recv = 0              # data delivered in order, after decompression
+    wire_bytes_recv = 0         # payloads as received, before decompression
     corrupted_pkts = 0
     pkts_sent = 0
     retransmissions = 0
@@ -29,96 +36,195 @@ class Receiver:
     def __init__(
         self,
         conn: NetworkLayer,
-        sender_ack_notifier: Callable[[int], any],
-        ws=10, logger: Logger=None
+        sender_ack_notifier: Callable[[int, list], any],
+        ws=10, logger: Logger=None, codec=None,
+        ack_every=2, ack_delay=0.04,
+        scheduler: TimerWheel=None,
+        compressor: Compression=None
     ):
         self.conn = conn
         self.logger = logger
+        self.codec = codec or TextCodec()
+        self.decoder = FrameDecoder(self.codec)
+        # Receiving window, in packets. Should be at least the sender's window
         self.ws = ws
-        self.recv_buffer = [None] * ws 
+        # Decompresses the payload of every packet as it is delivered in order,
+        # except on the control stream
+        self.compressor = compressor or Compression()
+        # Out-of-order packets inside the window, seq -> packet
+        self.recv_buffer = dict()
+        # Data of each stream other than 0 received so far, stream -> bytearray.
+        # A stream is delivered as one message to stream_callback once its fin
+        # arrives; without a stream_callback every stream goes to recv_callback
+        self.stream_buffers = dict()
+        self.stream_callback = None
+        # Set once the connection is closed and all the data received from it
+        # was handled, run returns then
+        self.conn_closed = threading.Event()
         self.sender_ack_notifier = sender_ack_notifier
+        self.status_lock = Lock()    # Lock for running status
+        self.control_lock = Lock()   # Lock for control variables
+        # Delayed ACKs: in-order packets are ACKed every ack_every packets, or
+        # ack_delay seconds after the first one not ACKed yet
+        self.ack_every = ack_every
+        self.unacked = 0
+        self.ack_timer = AsyncTimer(ack_delay, self._handle_ack_timeout, scheduler=scheduler)
 
-    def _recv(self, pkt: Packet, recv_callback: Callable[[str], any]):
+    # Decompresses the data of the packets delivered from now on with compressor
+    def set_compressor(self, compressor: Compression):
+        with self.control_lock:
+            self.compressor = compressor
+
+    # Ranges of seqs received after a hole, from the lowest one
+    def _sack_blocks(self) -> list:
+        if not self.recv_buffer:
+            return []
+        seqs = sorted(self.recv_buffer, key=lambda seq: seq_diff(seq, self.base))
+        blocks = []
+        start = end = seqs[0]
+        for seq in seqs[1:]:
+            if seq != seq_add(end, 1):
+                blocks.append((start, seq_add(end, 1)))
+                if len(blocks) == self.max_sack_blocks:
+                    return blocks
+                start = seq
+            end = seq
+        blocks.append((start, seq_add(end, 1)))
+        return blocks
+
+    # Sends a cumulative ACK for everything before base, along with the SACK
+    # blocks. Called with control_lock held
+    def _send_ack(self):
+        self.ack_timer.stop()
+        self.unacked = 0
+        if self.logger: self.logger.mark_event(ACK_SENT, self.base, self.base)
+        self.conn.udt_send(self.codec.encode(Packet(self.base, ack=True, sack=self._sack_blocks())))
+        self.pkts_sent += 1
+
+    def _handle_ack_timeout(self):
+        with self.control_lock:
+            if self.unacked:
+                self._send_ack()
+
+    # Splits in-order packets into the data of stream 0 and the streams
+    # completed by them, as (stream, data). Called with control_lock held
+    def _reassemble(self, pkts: list) -> tuple:
+        chunks = []
+        completed = []
+        for pkt in pkts:
+            if pkt.stream == 0:
+                chunks.append(pkt.msg_S)
+                continue
+            buffer = self.stream_buffers.setdefault(pkt.stream, bytearray())
+            buffer += pkt.msg_S
+            if pkt.fin:
+                completed.append((pkt.stream, bytes(self.stream_buffers.pop(pkt.stream))))
+        return b''.join(chunks), completed
+
+    def _recv(self, pkt: Packet, recv_callback: Callable[[bytes], any]):
         seq = pkt.seq_num
         msg = pkt.msg_S
 
         if pkt.is_ack_pack():
-            self.sender_ack_notifier(seq)
+            self.sender_ack_notifier(seq, pkt.sack)
             return
 
-        usable_len = int(self.ws/2)
-
         debug_log(f'[sr recver]: Received pkt seq: {seq}, curr base: {self.base}')
         if self.logger: self.logger.mark_event(DATA_RECV, self.base, seq, msg)
 
-        # If seq number is out of the expected waiting range, send repeated ACK.
-        # We trust that the sender is correctly synchronized with us, 
-        if (seq - self.base) % self.ws + 1 > usable_len:
-            debug_log(f'[sr recver]: Pkt outside range, resending ACK...')
-            if self.logger: self.logger.mark_event(DUP_DATA, self.base, seq)
-            self.pkts_sent += 1
-            self.retransmissions += 1
-            self.conn.udt_send(Packet(seq, ack=True).get_byte_S())
-            return
+        data = None
+        completed = ()
+        with self.control_lock:
+            offset = seq_diff(seq, self.base)
+            if offset >= self.ws:
+                # Packets from the previous window were already delivered, but
+                # their ACK may have been lost, so ACK again. Anything else is
+                # beyond the window and is dropped.
+                if seq_diff(self.base, seq) <= self.ws:
+                    debug_log(f'[sr recver]: Pkt outside range, resending ACK...')
+                    if self.logger: self.logger.mark_event(DUP_DATA, self.base, seq)
+                    self.retransmissions += 1
+                    self._send_ack()
+                else:
+                    debug_log(f'[sr recver] WARNING: Pkt ahead of window, dropping...')
+                return
 
-        # If seq number received is equal to the base, update the base of the 
-        # receiving window, otherwise, save packet in the out-of-order buffer.
-        if seq == self.base:
-            counter = 0
-            for buffered in self.recv_buffer:
-                if buffered == None:
-                    break
-                counter += 1
+            # If seq number received is equal to the base, update the base of the 
+            # receiving window, otherwise, save packet in the out-of-order buffer.
+            if offset == 0:
+                pkts = [pkt]
+                next_seq = seq_add(seq, 1)
+                while next_seq in self.recv_buffer:
+                    pkts.append(self.recv_buffer.pop(next_seq))
+                    next_seq = seq_add(next_seq, 1)
 
-            data = ''.join([msg] + self.recv_buffer[:counter])
-            self.base = (self.base + counter + 1) % self.ws
+                self.wire_bytes_recv += sum(len(p.msg_S) for p in pkts)
+                for p in pkts:
+                    if p.stream != CONTROL_STREAM:
+                        p.msg_S = self.compressor.decompress(p.msg_S)
+                self.bytes_recv += sum(len(p.msg_S) for p in pkts)
+                if self.stream_callback is None:
+                    # Control messages are never delivered as data
+                    data = b''.join(p.msg_S for p in pkts if p.stream != CONTROL_STREAM)
+                else:
+                    data, completed = self._reassemble(pkts)
+                self.base = next_seq
 
-            debug_log(f'[sr recver]: Received base seq number, updating base and sending data')
-            debug_log(f'             Packets recv: {counter + 1}')
+                debug_log(f'[sr recver]: Received base seq number, updating base and sending data')
+                debug_log(f'             Packets recv: {len(pkts)}')
 
-            # Send data to upper-layer and clean recv buffer
-            recv_callback(data)
-            self.bytes_recv += len(data)
-
-            self.recv_buffer = self.recv_buffer[counter+1:] + ([None] * (counter+1))
-        else:
-            relative_seq = (seq - self.base) % usable_len - 1
-            if self.recv_buffer[relative_seq] == None:
-                # Save out of order package:
-                # The seq number relative to the current base
-                debug_log(f'[sr recver]: Saving out-of-order pkt')
-                if self.logger: self.logger.mark_event(OUT_OF_ORDER, self.base, seq)
-                self.recv_buffer[relative_seq] = msg
+                # In order packets are ACKed lazily, filling a hole is ACKed
+                # right away so the sender learns about it
+                self.unacked += 1
+                if len(pkts) > 1 or self.unacked >= self.ack_every:
+                    self._send_ack()
+                elif self.unacked == 1:
+                    self.ack_timer.start()
             else:
-                debug_log(f'[sr recver]: Repeated pkt, resending ACK...')
-                if self.logger: self.logger.mark_event(DUP_DATA, self.base, seq)
-                self.retransmissions += 1
+                if seq not in self.recv_buffer:
+                    # Save out of order package
+                    debug_log(f'[sr recver]: Saving out-of-order pkt')
+                    if self.logger: self.logger.mark_event(OUT_OF_ORDER, self.base, seq)
+                    self.recv_buffer[seq] = pkt
+                else:
+                    debug_log(f'[sr recver]: Repeated pkt, resending ACK...')
+                    if self.logger: self.logger.mark_event(DUP_DATA, self.base, seq)
+                    self.retransmissions += 1
+                # Out of order packets are ACKed right away
+                self._send_ack()
 
-        if self.logger: self.logger.mark_event(ACK_SENT, self.base, seq)
-        self.conn.udt_send(Packet(seq, ack=True).get_byte_S())
-        self.pkts_sent += 1
+        # Send data to upper-layer
+        if data:
+            recv_callback(data)
+        for stream, stream_data in completed:
+            self.stream_callback(stream, stream_data)
 
     # Main method of the receiver, should be only called once before the stop
-    # method is called
-    def run(self, recv_callback: Callable[[str], any]):
+    # method is called. Streams other than 0 are delivered whole to
+    # stream_callback, if given
+    def run(self, recv_callback: Callable[[bytes], any], stream_callback: Callable[[int, bytes], any]=None):
         with self.status_lock:
             if self.running:
                 print('ERROR: Receiver instance already running')
                 return
             self.running = True
+        self.stream_callback = stream_callback
 
         debug_log('Started Selective Repeat receiver!')
         debug_log(f'WINDOW SIZE: {self.ws}\n')
 
         while self.running:
-            data_recv = self.conn.udt_receive()
-            if data_recv == '':
+            data_recv = self.conn.udt_receive(timeout=self.poll_timeout)
+            if not data_recv:
+                if self.conn.is_closed():
+                    self.conn_closed.set()
+                    break
                 continue
             # Get packets that are not corrupt and receive them
             self.last_recv_time = time()
-            pkts, corrupt = getPackets(data_recv)
-            if corrupt:
-                self.corrupted_pkts += 1
+            pkts, corrupted = self.decoder.get_packets(data_recv)
+            if corrupted:
+                self.corrupted_pkts += corrupted
                 if self.logger: self.logger.mark_event(CORRUPT)
             for p in pkts:
                 self._recv(p, recv_callback)
@@ -132,16 +238,23 @@ class Receiver:
                 return
             self.running = False
         
+        self.ack_timer.stop()
         self.last_recv_time = 0
         self.base = 0
+        self.recv_buffer = dict()
+        self.stream_buffers = dict()
+        self.unacked = 0
 
     def get_stats(self):
         with self.control_lock:
             return {
                 'bytes_recv': self.bytes_recv,
+                'wire_bytes_recv': self.wire_bytes_recv,
                 'corrupted_pkts': self.corrupted_pkts,
+                'skipped_bytes': self.decoder.skipped_bytes,
                 'ack_pkts_sent': self.pkts_sent,
                 'retransmissions': self.retransmissions,
+                **self.compressor.get_stats(),
             }
 
 
@@ -155,7 +268,7 @@ if __name__ == '__main__':
     global recv_buffer
     recv_buffer = []
 
-    def callback(msg: str):
+    def callback(msg: bytes):
         recv_buffer.append(msg)
 
     conn = None
@@ -1,93 +1,311 @@
 import sys, argparse
-from threading import Thread, Lock, Semaphore
-from time import sleep
+from threading import Thread, Lock, Condition
+from collections import deque, OrderedDict
+from time import sleep, monotonic
 
 # Hacky fix to import from parent folder
 path_slip = __file__.split('/')
 sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
 
 from Network import NetworkLayer
-from RDT import Packet
+from RDT import Packet, TextCodec, MAX_STREAM, CONTROL_STREAM
 from async_timer import AsyncTimer
+from timer_wheel import TimerWheel
+from rtt import RttEstimator
+from congestion import CongestionController, FixedWindow
+from compression import Compression
 from utils import debug_log
+from seqnum import seq_add, seq_diff, seq_lt
 from log_event import *
 
 class Sender:
     # State control variables
     base = 0
     next_seq = 0
-    pkts_in_air = dict()
-    ack_queue = []
     running = False
-    timer = []
-    status_lock = Lock()    # Lock for running status
-    control_lock = Lock()   # Lock for control variables
-    queue_lock = Lock()     # Lock for ack queue
     # Stats variables
-    bytes_sent = 0
+    bytes_sent = 0              # data given by the layer above, before compression
+    wire_bytes_sent = 0         # payloads as sent, after compression
     pkts_sent = 0
-    retransmissions = 0
+    retransmissions = 0         # every retransmission, fast ones included
+    fast_retransmissions = 0
+    # Packets ACKed after a hole, or duplicate ACKs, that mark a packet as lost
+    dup_thresh = 3
+    # Bytes each stream with data queued may send per scheduling round
+    quantum = 1024
+    # Chunks queued per stream before send blocks
+    stream_queue_limit = 32
 
-    def __init__(self, conn: NetworkLayer, ws=10, timeout_sec=2, logger: Logger=None):
+    def __init__(
+        self,
+        conn: NetworkLayer,
+        ws=10, timeout_sec=2,
+        logger: Logger=None, codec=None,
+        scheduler: TimerWheel=None,
+        cc: CongestionController=None,
+        compressor: Compression=None
+    ):
         self.conn = conn
         self.logger = logger
+        self.codec = codec or TextCodec()
+        # Faults injected by the network leave alone what the codec needs intact
+        self.conn.corrupt_offset = self.codec.corrupt_offset
+        # Maximum window, in packets. Sequence numbers are 32-bit, so it's only
+        # bounded by the receiver's window
         self.ws = ws
-        self.semph = Semaphore(int(ws/2))
-        self.timer = [AsyncTimer(timeout_sec, self._handle_timeout, args=[seq]) for seq in range(ws)]
+        self.scheduler = scheduler
+        # The congestion controller decides how far next_seq can get ahead of
+        # base, never more than the maximum window
+        self.cc = cc or FixedWindow()
+        self.cc.max_window = ws
+        # Compresses the payload of every packet as it gets its seq, except on
+        # the control stream
+        self.compressor = compressor or Compression()
+        # Packets sent and not ACKed yet, in seq order. OrderedDict keeps access
+        # to the oldest one O(1) after removing from the front
+        self.pkts_in_air = OrderedDict()
+        # seq -> [time of the first transmission, number of timeouts, fast retransmitted,
+        #         data length before compression]
+        self.tx_info = dict()
+        # Last cumulative ack point received and how many times in a row
+        self.last_cum_ack = None
+        self.dup_acks = 0
+        self.ack_queue = deque()
+        # Retransmission timeout is adapted to the measured RTT, starting from timeout_sec
+        self.rtt = RttEstimator(initial_rto=timeout_sec)
+        self.status_lock = Lock()               # Lock for running status
+        self.control_lock = Lock()              # Lock for control variables
+        self.window_open = Condition(self.control_lock)
+        self.ack_ready = Condition(Lock())      # Lock and signal for ack queue
+        # Retransmission timer of each packet in-air, seq -> AsyncTimer. Every
+        # timer is armed on the same wheel, served by one thread
+        self.timer = dict()
+        # Data waiting for room in the window, stream -> deque of (data, fin).
+        # Streams with data queued take turns in active_streams, each one
+        # sending up to its deficit in bytes per turn (deficit round robin), so
+        # small streams don't wait behind bulk ones
+        self.stream_queues = dict()
+        self.active_streams = deque()
+        self.deficit = dict()
+        # Highest stream id handed out and the ones closed since, reused first
+        self.last_stream = 0
+        self.free_streams = []
 
-    # Timeout handler for each packet in-air, called by Timer threading objects
+    # Timeout handler for each packet in-air, called by the timer wheel thread
     def _handle_timeout(self, seq: int):
         with self.control_lock:
-            pkt = self.pkts_in_air[seq]
+            pkt = self.pkts_in_air.get(seq)
+            # The ACK may have arrived while the timer was firing
+            if pkt is None:
+                return
             debug_log(f'[sr sender]: TIMEOUT, resending seq: {seq}, curr base: {self.base}')
             if self.logger: self.logger.mark_event(TIMEOUT, self.base, seq, pkt.msg_S)
-            self.conn.udt_send(pkt.get_byte_S())
+            info = self.tx_info[seq]
+            self.conn.udt_send(self.codec.encode(pkt))
             self.pkts_sent += 1
-            self.bytes_sent += len(pkt.msg_S)
+            self.bytes_sent += info[3]
+            self.wire_bytes_sent += len(pkt.msg_S)
             self.retransmissions += 1
+
+            # Exponential backoff for each timeout of the same packet
+            info[1] += 1
+            self.cc.on_timeout(info[0], monotonic())
+            self.timer[seq].change_timeout(self.rtt.timeout(info[1]))
             self.timer[seq].start()
 
     # Method called from layer above (server or client) to send data through
-    # reliable tunnel 
-    def send(self, data: str):
-        self.semph.acquire()
+    # reliable tunnel, on stream 0 or one opened with open_stream. fin marks the
+    # last data of a stream. Data is queued and sent as the window opens, and
+    # the call blocks while too much of the stream is queued
+    def send(self, data: bytes, stream: int=0, fin: bool=False):
         with self.status_lock:
             if not self.running:
                 print('ERROR: Run sender before calling "send" method')
 
         with self.control_lock:
-            seq = self.next_seq
-            pkt = Packet(seq, str(data))
-            self.pkts_in_air[seq] = pkt
+            self.window_open.wait_for(
+                lambda: len(self.stream_queues.get(stream, ())) < self.stream_queue_limit
+            )
+            queue = self.stream_queues.get(stream)
+            if queue is None:
+                queue = self.stream_queues[stream] = deque()
+                self.active_streams.append(stream)
+                self.deficit[stream] = 0
+            queue.append((data, fin))
+            self._schedule()
 
-            debug_log(f'[sr sender]: Sent packet, seq: {seq}, msg len: {len(data)}, curr base: {self.base}')
-            if self.logger: self.logger.mark_event(PKT_SENT, self.base, seq, data)
+    # Returns the id of a new stream. Its data is delivered to the receiver as
+    # one message, once the data sent with fin arrives. Ids go from 1 to
+    # MAX_STREAM, those of closed streams are reused
+    def open_stream(self) -> int:
+        with self.control_lock:
+            if self.free_streams:
+                return self.free_streams.pop()
+            if self.last_stream >= MAX_STREAM:
+                raise RuntimeError(f'No stream ids left, {MAX_STREAM} streams open')
+            self.last_stream += 1
+            return self.last_stream
 
-            self.conn.udt_send(pkt.get_byte_S())
-            self.pkts_sent += 1
-            self.bytes_sent += len(pkt.msg_S)
+    # Gives back the id of a stream opened with open_stream, once the peer is
+    # done with it
+    def close_stream(self, stream: int):
+        with self.control_lock:
+            self.free_streams.append(stream)
 
-            self.timer[seq].start()
-            self.next_seq = (self.next_seq + 1) % self.ws
+    # Compresses the data of the packets sent from now on with compressor
+    def set_compressor(self, compressor: Compression):
+        with self.control_lock:
+            self.compressor = compressor
 
-    # Method called from receiver to notify sender that ack was received.
-    def notify_ack(self, seq: int):
-        with self.queue_lock:
-            self.ack_queue.append(seq)
+    # Sends the chunks of a message on a stream, with fin on the last one
+    def send_message(self, stream: int, chunks: list):
+        for i, chunk in enumerate(chunks):
+            self.send(chunk, stream, fin=i == len(chunks) - 1)
+        if not chunks:
+            self.send(b'', stream, fin=True)
 
-    # Internal method called by the sender's main loop when there are ACK enqueued
-    # Updates base and releases sender's semaphores
-    def _handle_ack(self, seq: int):
-        with self.control_lock:
-            if not self.pkts_in_air.get(seq):
-                debug_log(f'[sr sender] WARNING: Received unexpected ACK, seq: {seq}')
-                if self.logger: self.logger.mark_event(DUP_ACK, self.base, seq)
-                return
+    # Sends queued data while the window has room. Called with control_lock held
+    def _schedule(self):
+        while self.active_streams and self._window_available():
+            stream = self.active_streams[0]
+            queue = self.stream_queues[stream]
+            data, fin = queue[0]
+            if self.deficit[stream] < len(data):
+                # Turn over, the stream gets its quantum for the next one
+                self.deficit[stream] += self.quantum
+                self.active_streams.rotate(-1)
+                continue
+            queue.popleft()
+            self.deficit[stream] -= len(data)
+            self._transmit(data, stream, fin)
+            if not queue:
+                self.active_streams.popleft()
+                del self.stream_queues[stream]
+                del self.deficit[stream]
+        self.window_open.notify_all()
+
+    # Sends data in a new packet and arms its timer. Called with control_lock
+    # held, once the window has room
+    def _transmit(self, data: bytes, stream: int=0, fin: bool=False):
+        seq = self.next_seq
+        length = len(data)
+        if stream != CONTROL_STREAM:
+            data = self.compressor.compress(data)
+        pkt = Packet(seq, data, stream=stream, fin=fin)
+        self.pkts_in_air[seq] = pkt
+
+        debug_log(f'[sr sender]: Sent packet, seq: {seq}, msg len: {len(data)}, curr base: {self.base}')
+        if self.logger: self.logger.mark_event(PKT_SENT, self.base, seq, data)
+
+        self.conn.udt_send(self.codec.encode(pkt))
+        self.pkts_sent += 1
+        self.bytes_sent += length
+        self.wire_bytes_sent += len(pkt.msg_S)
+
+        self.tx_info[seq] = [monotonic(), 0, False, length]
+        self.timer[seq] = AsyncTimer(self.rtt.timeout(), self._handle_timeout, args=[seq], scheduler=self.scheduler)
+        self.timer[seq].start()
+        self.next_seq = seq_add(self.next_seq, 1)
+
+    # Number of packets from base to next_seq, still in-air or not
+    def _window_available(self) -> bool:
+        return seq_diff(self.next_seq, self.base) < self.cc.window()
+
+    # Method called from receiver to notify sender that an ACK was received,
+    # with its cumulative ack point and SACK blocks.
+    def notify_ack(self, seq: int, sack: list=()):
+        with self.ack_ready:
+            self.ack_queue.append((seq, sack))
+            self.ack_ready.notify()
 
-            debug_log(f'[sr sender]: Received ACK, seq: {seq}, curr base: {self.base}')
-            self.timer[seq].stop()
-            del self.pkts_in_air[seq]
+    # Removes an ACKed packet from the in-air ones. Returns the time it was
+    # sent if it can be used as an RTT sample. Called with control_lock held
+    def _ack_packet(self, seq: int):
+        debug_log(f'[sr sender]: Received ACK, seq: {seq}, curr base: {self.base}')
+        self.timer.pop(seq).stop()
+        del self.pkts_in_air[seq]
+        sent_time, timeouts, fast_retransmitted, _ = self.tx_info.pop(seq)
+        if self.logger: self.logger.mark_event(ACK_RECV, self.base, seq)
+        # Karn's algorithm: only packets sent once give valid RTT samples
+        return sent_time if timeouts == 0 and not fast_retransmitted else None
+
+    # Retransmits, before their timer expires, the packets that later ACKs show
+    # as lost: the oldest in-air packet after dup_thresh duplicate ACKs, and any
+    # packet with dup_thresh packets sent after it already ACKed (SACK hole).
+    # Each packet is fast retransmitted only once. Called with control_lock held
+    def _fast_retransmit(self, now: float):
+        in_air = len(self.pkts_in_air)
+        for i, (seq, pkt) in enumerate(self.pkts_in_air.items()):
+            # packets sent after seq that are not in-air anymore
+            acked_after = seq_diff(self.next_seq, seq) - in_air + i
+            lost = acked_after >= self.dup_thresh or (i == 0 and self.dup_acks >= self.dup_thresh)
+            if not lost:
+                break
+            info = self.tx_info[seq]
+            if info[2]:
+                continue
+            info[2] = True
+
+            debug_log(f'[sr sender]: FAST RETRANSMIT, resending seq: {seq}, curr base: {self.base}')
+            if self.logger: self.logger.mark_event(FAST_RETX, self.base, seq, pkt.msg_S)
+            self.conn.udt_send(self.codec.encode(pkt))
+            self.pkts_sent += 1
+            self.bytes_sent += info[3]
+            self.wire_bytes_sent += len(pkt.msg_S)
+            self.retransmissions += 1
+            self.fast_retransmissions += 1
+            self.cc.on_loss(info[0], now)
+            self.timer[seq].change_timeout(self.rtt.timeout(info[1]))
+            self.timer[seq].start()
+
+    # Internal method called by the sender's main loop with every ACK enqueued
+    # since the last call. Updates base and the congestion window, then wakes
+    # up senders waiting for room once for the whole batch
+    def _handle_acks(self, acks: list):
+        with self.control_lock:
             old_base = self.base
+            now = monotonic()
+            acked = 0
+            rtt_sample = None
+
+            for cum_ack, sack in acks:
+                # Every packet before the cumulative ack point was received.
+                # pkts_in_air is ordered by seq, so they are all at its front
+                newly_acked = []
+                while self.pkts_in_air:
+                    seq = next(iter(self.pkts_in_air))
+                    if not seq_lt(seq, cum_ack):
+                        break
+                    newly_acked.append(self._ack_packet(seq))
+
+                # Along with the ones in the SACK blocks
+                for start, end in sack:
+                    length = seq_diff(end, start)
+                    if length > self.ws:
+                        continue
+                    for i in range(length):
+                        seq = seq_add(start, i)
+                        if seq in self.pkts_in_air:
+                            newly_acked.append(self._ack_packet(seq))
+
+                # Same cumulative ack point again while packets are in-air
+                if cum_ack == self.last_cum_ack and self.pkts_in_air:
+                    self.dup_acks += 1
+                else:
+                    self.dup_acks = 0
+                self.last_cum_ack = cum_ack
+
+                if not newly_acked:
+                    debug_log(f'[sr sender]: Duplicate ACK, seq: {cum_ack}, curr base: {self.base}')
+                    if self.logger: self.logger.mark_event(DUP_ACK, self.base, cum_ack)
+                    continue
+
+                # One RTT sample per ACK, from the latest packet it covers
+                acked += len(newly_acked)
+                sent_times = [t for t in newly_acked if t is not None]
+                if sent_times:
+                    rtt_sample = now - max(sent_times)
+                    self.rtt.sample(rtt_sample)
 
             # Updates base. Should be equal to the least recent seq sent
             if len(self.pkts_in_air) != 0:
@@ -95,12 +313,24 @@ class Sender:
             else:
                 self.base = self.next_seq
 
-            if self.logger: self.logger.mark_event(ACK_RECV, self.base, seq)
-
-            # Release semaphores only if base changed
+            if acked:
+                self.cc.on_ack(acked, rtt_sample)
+            self._fast_retransmit(now)
             if self.base != old_base:
                 debug_log(f'[sr sender]: Shifted base: {self.base}')
-                self.semph.release((self.base - old_base) % self.ws)
+            self._wake_senders()
+
+    # Sends the queued data that fits in the window and wakes up the callers of
+    # send waiting for room. Called with control_lock held
+    def _wake_senders(self):
+        self._schedule()
+
+    # Takes every ACK enqueued since the last call
+    def _take_acks(self) -> list:
+        with self.ack_ready:
+            acks = list(self.ack_queue)
+            self.ack_queue.clear()
+        return acks
 
     # Main method of the sender, should be only called once before the stop
     # method is called
@@ -115,11 +345,12 @@ class Sender:
         debug_log(f'WINDOW SIZE: {self.ws}\n')
 
         while self.running:
-            with self.queue_lock: 
-                if len(self.ack_queue) == 0: continue
-                seq = self.ack_queue[0]
-                self.ack_queue = self.ack_queue[1:]
-            self._handle_ack(seq)
+            # Sleeps until ACKs arrive, then takes all of them at once
+            with self.ack_ready:
+                self.ack_ready.wait_for(lambda: self.ack_queue or not self.running)
+            acks = self._take_acks()
+            if acks:
+                self._handle_acks(acks)
 
         debug_log('Stopped Selective Repeat sender!')
     
@@ -130,22 +361,37 @@ class Sender:
                 return
             self.running = False
 
-        for timer in self.timer: timer.stop()
+        with self.ack_ready:
+            self.ack_queue.clear()
+            self.ack_ready.notify_all()
+        for timer in self.timer.values(): timer.stop()
+        self.timer = dict()
         self.base = 0
         self.next_seq = 0
-        self.ack_queue = []
-        self.pkts_in_air = dict()
+        self.pkts_in_air = OrderedDict()
+        self.tx_info = dict()
+        self.last_cum_ack = None
+        self.dup_acks = 0
+        self.stream_queues = dict()
+        self.active_streams = deque()
+        self.deficit = dict()
 
     def pending_packets(self) -> bool:
         with self.control_lock:
-            return len(self.pkts_in_air) > 0
+            return len(self.pkts_in_air) > 0 or len(self.active_streams) > 0
 
     def get_stats(self):
         with self.control_lock:
             return {
                 'bytes_sent': self.bytes_sent,
+                'wire_bytes_sent': self.wire_bytes_sent,
                 'retransmissions': self.retransmissions,
+                'fast_retransmissions': self.fast_retransmissions,
                 'pkts_sent': self.pkts_sent,
+                'rto': self.rtt.rto,
+                'srtt': self.rtt.srtt,
+                **self.cc.get_stats(),
+                **self.compressor.get_stats(),
             }
 
 
@@ -165,7 +411,7 @@ if __name__ == '__main__':
         runner = Thread(target=sender.run)
         runner.start()
 
-        for msg in "TESTE1 TESTE2 TESTE3 TESTE4 TESTE5 TESTE6 TESTE7 TESTE8 TESTE9 TESTE10 TESTE11".split(' '):
+        for msg in b"TESTE1 TESTE2 TESTE3 TESTE4 TESTE5 TESTE6 TESTE7 TESTE8 TESTE9 TESTE10 TESTE11".split(b" "):
             sender.send(msg)
         while sender.pending_packets():
             sleep(1)
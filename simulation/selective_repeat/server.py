@@ -1,27 +1,38 @@
-import sys, argparse
-from threading import Thread, Lock
+import sys, argparse, asyncio, traceback
+from threading import Thread, Condition
+from multiprocessing import Process, Queue
 from typing import Callable
 from time import time
 from sender import Sender
 from receiver import Receiver
+from aio import AsyncSession, start_server
 
 # Hacky fix to import from parent folder
 path_slip = __file__.split('/')
 sys.path.append('/'.join(path_slip[0:len(path_slip)-2]))
 
 from Network import NetworkLayer
+from link import Link
+from RDT import get_codec, CONTROL_STREAM
+from congestion import get_controller
+from compression import get_compressor, accept_offer
 from log_event import Logger
 import constants as c
 import utils
+from utils import debug_log, write_stats
 
-def default_reponse(data: str):
+def default_reponse(data: bytes):
     return data
 
+# Only ASCII letters are changed, so any binary data goes through
+def uppercase(data: bytes):
+    return data.upper()
+
 class Server(Thread):
     def __init__(
         self,
         server: str, port: str,
-        response_func: Callable[[str], str]=None,
+        response_func: Callable[[bytes], bytes]=None,
         logger: Logger=None
     ):
         Thread.__init__(self)
@@ -33,36 +44,64 @@ class Server(Thread):
     def run(self):
         # Initialize state variables
         global recv_buffer
-        recv_buffer = ''
+        recv_buffer = bytearray()
 
         # Mutex to control access to recv_buffer, since the recver and main threads
-        # will both access it simutaneously
-        buffer_mutex = Lock() 
-        self.conn = NetworkLayer('server', self.server, self.port)
-        self.sender = Sender(self.conn, ws=c.WINDOW_SIZE, timeout_sec=c.TIMEOUT, logger=self.logger)
-        self.recver = Receiver(self.conn, self.sender.notify_ack, ws=c.WINDOW_SIZE, logger=self.logger)
+        # will both access it simutaneously. Also signals the main thread when
+        # data arrives
+        buffer_mutex = Condition()
+        self.conn = NetworkLayer(
+            'server', self.server, self.port, transport=c.TRANSPORT,
+            link=Link(c.LINK_DELAY, c.LINK_JITTER, c.LINK_JITTER_DIST, c.LINK_BANDWIDTH, c.LINK_QUEUE, c.LINK_QUEUE_POLICY)
+        )
+        codec = get_codec(c.CODEC, c.CHECKSUM)
+        self.sender = Sender(
+            self.conn, ws=c.WINDOW_SIZE, timeout_sec=c.TIMEOUT, logger=self.logger, codec=codec,
+            cc=get_controller(c.CONGESTION)
+        )
+        self.recver = Receiver(
+            self.conn, self.sender.notify_ack, ws=c.WINDOW_SIZE, logger=self.logger, codec=codec,
+            ack_every=c.DELAYED_ACK_PKTS, ack_delay=c.DELAYED_ACK_TIMEOUT
+        )
 
         # Callback called by Receiver when data arrives
-        def recv_callback(msg: str):
+        def recv_callback(msg: bytes):
             with buffer_mutex:
                 global recv_buffer
                 recv_buffer += msg
+                buffer_mutex.notify()
+
+        # Callback called by Receiver when a request on a stream other than 0
+        # is complete. The response goes back on the same stream from its own
+        # thread, so it's sent alongside bulk data instead of behind it
+        def stream_callback(stream: int, msg: bytes):
+            if stream == CONTROL_STREAM:
+                self._negotiate(msg)
+                return
+            response = self.response_func(msg)
+            Thread(
+                target=self.sender.send_message,
+                args=[stream, utils.getChunks(c.PACKET_SIZE, response)],
+                daemon=True
+            ).start()
 
         # Runs sender and recver threads separately
         sender_t = Thread(target=self.sender.run)
-        recver_t = Thread(target=self.recver.run, args=[recv_callback])
+        recver_t = Thread(target=self.recver.run, args=[recv_callback, stream_callback])
         sender_t.start()
         recver_t.start()
 
         # Waits for no data to arrive for some time before closing connection to
-        # the client
-        while self.recver.last_recv_time == 0 or time() < self.recver.last_recv_time + c.TIMEOUT + 5 :
+        # the client, unless the client closed it
+        while not self.recver.conn_closed.is_set() and (
+                self.recver.last_recv_time == 0 or time() < self.recver.last_recv_time + c.TIMEOUT + 5):
             # Get chunks
             with buffer_mutex:
+                buffer_mutex.wait_for(lambda: len(recv_buffer) > 0, timeout=1)
                 if len(recv_buffer) == 0:
                     continue
                 chunks = utils.getChunks(c.PACKET_SIZE, recv_buffer)
-                recv_buffer = ''
+                recv_buffer = bytearray()
 
             # Send processed data outside of lock so we are dead-lock free
             for chunk in chunks:
@@ -74,6 +113,17 @@ class Server(Thread):
         recver_t.join()
         self.conn.disconnect()
 
+    # Answers a compression offer from the client, "<name> <level>", with the
+    # compression used from now on: the one offered if it is valid, none
+    # otherwise. Called by the receiver thread, so packets after the offer are
+    # decompressed; the client sends nothing else until it has the answer
+    def _negotiate(self, offer: bytes):
+        name, level = accept_offer(offer)
+        debug_log(f'[server]: Compression offered: {offer}, using: {name}')
+        self.recver.set_compressor(get_compressor(name, level))
+        self.sender.set_compressor(get_compressor(name, level))
+        self.sender.send_message(CONTROL_STREAM, [f'{name} {level}'.encode('utf-8')])
+
     def get_conn_stats(self):
         return self.conn.get_stats()
 
@@ -85,24 +135,192 @@ class Server(Thread):
         }
 
 
+class MultiServer:
+    """Serves many clients at the same time on one event loop.
+
+    Every connection gets its own AsyncSession, with its own sender and
+    receiver state, and its stats are kept once it finishes.
+    """
+
+    def __init__(
+        self,
+        server: str, port: int,
+        response_func: Callable[[bytes], bytes]=None,
+        transport=c.TRANSPORT,
+        max_clients: int=None
+    ):
+        self.server = server
+        self.port = port
+        self.response_func = response_func or default_reponse
+        self.transport = transport
+        # Stops after serving max_clients connections, runs forever if None
+        self.max_clients = max_clients
+        # Stats of every connection finished, in the order they finished
+        self.connections = []
+
+    async def handle(self, session: AsyncSession):
+        peer = session.network.addr
+        start_time = time()
+        debug_log(f'[server]: Client {peer} connected')
+
+        # Requests on other streams are answered on their own stream, alongside
+        # the data of stream 0
+        async def answer(stream: int, data: bytes):
+            try:
+                await session.send(self.response_func(data), stream)
+            except ConnectionResetError:
+                pass
+
+        async def serve_streams():
+            answers = set()
+            while (message := await session.recv_stream()) is not None:
+                task = asyncio.create_task(answer(*message))
+                answers.add(task)
+                task.add_done_callback(answers.discard)
+            await asyncio.gather(*answers)
+
+        streams = asyncio.create_task(serve_streams())
+
+        # Serves the client until it closes the connection or no data arrives
+        # for some time. The connection counts as served however it ends
+        try:
+            while True:
+                data = await session.recv(timeout=c.TIMEOUT + 5)
+                if not data:
+                    break
+                await session.send(self.response_func(data))
+        except ConnectionResetError:
+            debug_log(f'[server]: Client {peer} connection reset')
+        finally:
+            # Last ACK or data received, stop resets it
+            end_time = max(session.recver.last_recv_time, start_time)
+            try:
+                await session.close(timeout=c.TIMEOUT + 5)
+                await streams
+            finally:
+                stats = session.get_stats()
+                stats['peer'] = peer
+                stats['start_time'] = start_time
+                stats['end_time'] = end_time
+                self.connections.append(stats)
+                write_stats(f'Client {peer}', [stats])
+                if self.max_clients is not None and len(self.connections) >= self.max_clients:
+                    self.done.set()
+
+    async def serve(self):
+        self.done = asyncio.Event()
+        server = await start_server(self.server, self.port, self.handle, transport=self.transport)
+        try:
+            await self.done.wait()
+        finally:
+            server.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    def get_stats(self):
+        return list(self.connections)
+
+
+# Serves one stripe in a process of its own and puts its stats in results
+def _serve_stripe(index: int, server: str, port: int, response_func, results: Queue):
+    try:
+        logger = Logger(capacity=0)
+        stripe = Server(server, port, response_func, logger=logger)
+        stripe.start()
+        stripe.join()
+        logger.close()
+        stats = stripe.get_stats()
+        stats['start_time'] = (logger.first_time or 0) / 10**9
+        stats['end_time'] = (logger.last_time or 0) / 10**9
+        results.put((index, stats))
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        results.put((index, None))
+
+class StripedServer:
+    """Serves a striped transfer, the file split by a StripedClient in ranges
+    sent over `stripes` connections at the same time.
+
+    Stripe i is served by its own Server on port + i, each one in a process of
+    its own, so stripes don't compete for one interpreter.
+    """
+
+    def __init__(
+        self,
+        server: str, port: int, stripes: int,
+        response_func: Callable[[bytes], bytes]=None
+    ):
+        self.server = server
+        self.port = port
+        self.stripes = stripes
+        self.response_func = response_func or default_reponse
+
+    # Serves every stripe and returns their stats, in stripe order
+    def run(self) -> list:
+        results = Queue()
+        procs = [
+            Process(target=_serve_stripe, args=[i, self.server, self.port + i, self.response_func, results])
+            for i in range(self.stripes)
+        ]
+        for p in procs: p.start()
+        # Taken before joining, a process doesn't exit until its results are read
+        stats = dict(results.get() for _ in procs)
+        for p in procs: p.join()
+        failed = [i for i, s in stats.items() if s is None]
+        if failed:
+            raise RuntimeError(f'Stripes failed: {failed}')
+        return [stats[i] for i in range(self.stripes)]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Selective Repeat Server.')
     parser.add_argument('server', help='Server.')
     parser.add_argument('port', help='Port.', type=int)
+    parser.add_argument('--multi', help='Serve many clients at the same time.', action='store_true')
+    parser.add_argument('--clients', help='Exit after serving this many clients (with --multi).', type=int)
+    parser.add_argument('--trace', help='Streams the event log to a trace file.')
+    parser.add_argument('--trace-format', help='Trace file format.', choices=['jsonl', 'binary'], default='jsonl')
+    parser.add_argument('--stripes', help='Serves a striped transfer over ports port to port+n-1.', type=int, default=1)
     args = parser.parse_args()
+    if args.multi and args.stripes > 1:
+        parser.error('--multi and --stripes can\'t be used together')
+    if args.clients is not None and not args.multi:
+        parser.error('--clients requires --multi')
+    if args.trace and (args.multi or args.stripes > 1):
+        parser.error('--trace can\'t be used with --multi or --stripes')
 
-    def uppercase(data: str):
-        return data.upper()
+    if args.multi:
+        server = MultiServer(args.server, args.port, uppercase, max_clients=args.clients)
+        server.run()
+        sys.stderr.write('\n')
+        sys.stderr.write(f"Clients served: {len(server.connections)}\n")
+        write_stats('Aggregate', server.connections)
+        sys.exit(0)
 
+    if args.stripes > 1:
+        try:
+            stats = StripedServer(args.server, args.port, args.stripes, uppercase).run()
+        except (Exception, KeyboardInterrupt) as err:
+            sys.exit('ERROR: ' + type(err).__name__ + '\n' + str(err))
+        sys.stderr.write('\n')
+        for i, stripe in enumerate(stats):
+            write_stats(f'Stripe {i}', [stripe])
+        write_stats('Aggregate', stats)
+        sys.exit(0)
+
+    logger = None
     try:
-        server = Server(args.server, args.port, uppercase, logger=Logger())
+        logger = Logger(capacity=0, trace=args.trace, trace_format=args.trace_format)
+        server = Server(args.server, args.port, uppercase, logger=logger)
         server.start()
         server.join()
 
-        first_pkt_time = server.logger.events[0].export()['time']
-        last_pkt_time  = server.logger.events[-1].export()['time']
-
-        elapsed_time = (last_pkt_time - first_pkt_time)/10**9
+        server.logger.close()
+        elapsed_time = server.logger.elapsed_ns()/10**9
         stats = server.get_stats()
         throughput = stats['bytes_sent'] + stats['bytes_recv']
         throughput = throughput*8/elapsed_time
@@ -115,11 +333,22 @@ if __name__ == '__main__':
         sys.stderr.write(f"Total data pkts (with retransmissions): {stats['sender']['pkts_sent']}\n")
         sys.stderr.write(f"Total ACK pkts (with retransmissions): {stats['recver']['ack_pkts_sent']}\n")
         sys.stderr.write(f"Total data retransmissions: {stats['sender']['retransmissions']}\n")
+        sys.stderr.write(f"Total data fast retransmissions: {stats['sender']['fast_retransmissions']}\n")
         sys.stderr.write(f"Total ACK retransmissions: {stats['recver']['retransmissions']}\n")
         sys.stderr.write(f"Total corrupted pkts: {stats['recver']['corrupted_pkts']}\n")
+        sys.stderr.write(f"Total link queue drops: {stats['link']['queue_drops'] + stats['link']['red_drops']}\n")
+        sys.stderr.write(f"Final congestion window: {stats['sender']['cwnd']:.2f} ({stats['sender']['controller']})\n")
+        sys.stderr.write(f"Final retransmission timeout: {stats['sender']['rto']:.3f}s\n")
         sys.stderr.write(f"Total communication time: {elapsed_time}s\n")
+        if stats['recver']['compression'] != 'none':
+            sys.stderr.write(f"Compression ({stats['recver']['compression']}): "
+                             f"{stats['recver']['uncompressed_bytes']} bytes received in {stats['recver']['compressed_bytes']}, "
+                             f"{stats['sender']['uncompressed_bytes']} bytes sent in {stats['sender']['compressed_bytes']}\n")
             
     except (Exception, KeyboardInterrupt) as err:
         sys.stderr.write('ERROR: ' + type(err).__name__ + '\n')
         sys.stderr.write(str(err))
         sys.stderr.write('\n')
+    finally:
+        # The trace keeps the events up to a failure
+        if logger: logger.close()
@@ -0,0 +1,19 @@
+# 32-bit sequence numbers, compared with serial number arithmetic (RFC 1982),
+# so they can wrap around as long as fewer than 2^31 packets are in flight.
+SEQ_BITS = 32
+SEQ_SPACE = 1 << SEQ_BITS
+SEQ_MASK = SEQ_SPACE - 1
+HALF_SPACE = SEQ_SPACE >> 1
+
+def seq_add(seq: int, n: int) -> int:
+    return (seq + n) & SEQ_MASK
+
+# Forward distance from start to seq
+def seq_diff(seq: int, start: int) -> int:
+    return (seq - start) & SEQ_MASK
+
+def seq_lt(a: int, b: int) -> bool:
+    return 0 < (b - a) & SEQ_MASK < HALF_SPACE
+
+def seq_leq(a: int, b: int) -> bool:
+    return a == b or seq_lt(a, b)
@@ -0,0 +1,137 @@
+import sys
+import threading
+import traceback
+from math import ceil
+from time import monotonic
+
+class TimerHandle:
+    __slots__ = ('expiry_tick', 'callback', 'args', 'slot')
+
+    def __init__(self, expiry_tick: int, callback, args):
+        self.expiry_tick = expiry_tick
+        self.callback = callback
+        self.args = args
+        # Set of the wheel holding the handle, None once expired or cancelled
+        self.slot = None
+
+    def active(self) -> bool:
+        return self.slot is not None
+
+
+class TimerWheel:
+    """Hashed timing wheel served by a single dispatcher thread.
+
+    Time is split into ticks of `tick` seconds, and every timer is stored in the
+    slot of the tick it expires on (modulo the number of slots), so arming and
+    cancelling a timer are O(1). The dispatcher wakes up once per tick while
+    there are timers armed, fires every expired timer of the slot as a batch and
+    sleeps without a timeout when the wheel is empty.
+    """
+
+    def __init__(self, tick=0.01, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.count = 0
+        self.start_time = monotonic()
+        # last tick processed by the dispatcher
+        self.current_tick = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+        self.running = False
+
+    def _now_tick(self) -> int:
+        return int((monotonic() - self.start_time) / self.tick)
+
+    def schedule(self, delay: float, callback, args=()) -> TimerHandle:
+        ticks = max(1, ceil(delay / self.tick))
+        with self.lock:
+            if not self.running:
+                self._start()
+            if self.count == 0:
+                # nothing armed, the dispatcher may be behind the clock
+                self.current_tick = self._now_tick()
+            handle = TimerHandle(self._now_tick() + ticks, callback, args)
+            handle.slot = self.slots[handle.expiry_tick % len(self.slots)]
+            handle.slot.add(handle)
+            self.count += 1
+            if self.count == 1:
+                self.changed.notify()
+        return handle
+
+    def cancel(self, handle: TimerHandle):
+        with self.lock:
+            if handle.slot is not None:
+                handle.slot.discard(handle)
+                handle.slot = None
+                self.count -= 1
+
+    def _start(self):
+        self.running = True
+        self.thread = threading.Thread(name='TimerWheel', target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.changed.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    # Removes and returns the timers that expired up to now_tick
+    def _expire(self, now_tick: int) -> list:
+        expired = []
+        n_slots = len(self.slots)
+        first = self.current_tick + 1
+        # after a long stall one pass over the wheel is enough
+        if now_tick - first >= n_slots:
+            first = now_tick - n_slots + 1
+
+        for tick in range(first, now_tick + 1):
+            slot = self.slots[tick % n_slots]
+            if not slot:
+                continue
+            due = [handle for handle in slot if handle.expiry_tick <= now_tick]
+            for handle in due:
+                slot.discard(handle)
+                handle.slot = None
+            expired.extend(due)
+
+        self.count -= len(expired)
+        self.current_tick = max(self.current_tick, now_tick)
+        return expired
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.running and self.count == 0:
+                    self.changed.wait()
+                if not self.running:
+                    return
+                next_tick = self.start_time + (self.current_tick + 1) * self.tick
+                delay = next_tick - monotonic()
+                if delay > 0:
+                    self.changed.wait(delay)
+                    if not self.running:
+                        return
+                expired = self._expire(self._now_tick())
+
+            # Callbacks run outside the lock, so they can arm new timers
+            for handle in expired:
+                try:
+                    handle.callback(*handle.args)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
+
+default_wheel = None
+_default_lock = threading.Lock()
+
+# Wheel shared by every timer that doesn't ask for a specific one
+def get_default_wheel() -> TimerWheel:
+    global default_wheel
+    with _default_lock:
+        if default_wheel is None:
+            default_wheel = TimerWheel()
+        return default_wheel
@@ -0,0 +1,186 @@
+import sys, argparse, json
+from log_event import *
+
+# NumPy is only needed by this tool, the simulation runs without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EVENT_NAMES = {
+    PKT_SENT: 'pkt_sent',
+    ACK_SENT: 'ack_sent',
+    TIMEOUT: 'timeout',
+    CORRUPT: 'corrupt',
+    DUP_ACK: 'dup_ack',
+    DUP_DATA: 'dup_data',
+    OUT_OF_ORDER: 'out_of_order',
+    ACK_RECV: 'ack_recv',
+    DATA_RECV: 'data_recv',
+    FAST_RETX: 'fast_retx',
+}
+
+# Same layout as log_event.TRACE_RECORD
+TRACE_DTYPE = [('type', '<u1'), ('time', '<i8'), ('base', '<u4'), ('seq', '<u4'), ('size', '<u4')]
+
+## Loads a trace file written by Logger as a structured array, in event order
+def load_trace(path: str):
+    with open(path, 'rb') as f:
+        binary = f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+    if binary:
+        return np.fromfile(path, dtype=TRACE_DTYPE, offset=len(TRACE_MAGIC))
+
+    fields = [name for name, _ in TRACE_DTYPE]
+    rows = [tuple(event[name] for name in fields) for event in read_trace(path)]
+    return np.array(rows, dtype=TRACE_DTYPE)
+
+# Time of the first event of each seq of a type, as (seqs, times)
+def first_by_seq(events, type: int):
+    selected = events[events['type'] == type]
+    seqs, index = np.unique(selected['seq'], return_index=True)
+    return seqs, selected['time'][index]
+
+def percentiles(values, ps=(50, 90, 99)) -> dict:
+    if len(values) == 0:
+        return {}
+    stats = {f'p{p}': float(v) for p, v in zip(ps, np.percentile(values, ps))}
+    stats['min'] = float(values.min())
+    stats['mean'] = float(values.mean())
+    stats['max'] = float(values.max())
+    return stats
+
+# RTTs in seconds of the packets sent once, from the first transmission to the
+# ACK (Karn's algorithm, as the sender does)
+def rtt_samples(events):
+    sent_seqs, sent_times = first_by_seq(events, PKT_SENT)
+    acked_seqs, acked_times = first_by_seq(events, ACK_RECV)
+    _, sent_i, acked_i = np.intersect1d(sent_seqs, acked_seqs, assume_unique=True, return_indices=True)
+
+    retransmitted = np.unique(events['seq'][np.isin(events['type'], (TIMEOUT, FAST_RETX))])
+    once = ~np.isin(sent_seqs[sent_i], retransmitted, assume_unique=True)
+    return (acked_times[acked_i][once] - sent_times[sent_i][once]) / 1e9
+
+# Rates in bits per second over intervals of `interval` seconds: payload
+# ACKed (by the sender's events) and data received (by the receiver's ones)
+def rates(events, start: int, interval: float) -> dict:
+    n_bins = int((events['time'][-1] - start) / 1e9 / interval) + 1
+    def per_bin(times, sizes):
+        bins = ((times - start) / 1e9 / interval).astype(np.int64)
+        return np.bincount(bins, weights=sizes, minlength=n_bins) * 8 / interval
+
+    sent = events[events['type'] == PKT_SENT]
+    seqs, index = np.unique(sent['seq'], return_index=True)
+    acked_seqs, acked_times = first_by_seq(events, ACK_RECV)
+    sizes = sent['size'][index][np.searchsorted(seqs, acked_seqs).clip(0, len(seqs) - 1)]
+    sizes = np.where(np.isin(acked_seqs, seqs, assume_unique=True), sizes, 0)
+
+    recv = events[events['type'] == DATA_RECV]
+    return {
+        'time': (np.arange(n_bins) * interval).tolist(),
+        'acked_bps': per_bin(acked_times, sizes).tolist(),
+        'recv_bps': per_bin(recv['time'], recv['size']).tolist(),
+    }
+
+# Packets in-air over time: up on the first transmission of a seq, down on its ACK
+def in_flight(events, start: int):
+    sent_seqs, sent_times = first_by_seq(events, PKT_SENT)
+    acked_seqs, acked_times = first_by_seq(events, ACK_RECV)
+    # ACKs of packets sent before the trace started are left out
+    acked_times = acked_times[np.isin(acked_seqs, sent_seqs, assume_unique=True)]
+    times = np.concatenate([sent_times, acked_times])
+    steps = np.concatenate([np.ones(len(sent_times), np.int64), -np.ones(len(acked_times), np.int64)])
+    order = np.argsort(times, kind='stable')
+    return (times[order] - start) / 1e9, np.cumsum(steps[order])
+
+# Transmissions of every seq sent more than once, longest chains first
+def retransmission_chains(events, start: int, limit: int) -> list:
+    sender = events[np.isin(events['type'], (PKT_SENT, TIMEOUT, FAST_RETX, ACK_RECV))]
+    retransmitted = np.unique(sender['seq'][np.isin(sender['type'], (TIMEOUT, FAST_RETX))])
+    sender = sender[np.isin(sender['seq'], retransmitted)]
+    if len(sender) == 0:
+        return []
+
+    order = np.lexsort((sender['time'], sender['seq']))
+    sender = sender[order]
+    bounds = np.flatnonzero(np.diff(sender['seq'])) + 1
+    chains = np.split(sender, bounds)
+    chains.sort(key=len, reverse=True)
+    return [
+        {
+            'seq': int(chain['seq'][0]),
+            'events': [(EVENT_NAMES[int(t)], float((time - start) / 1e9)) for t, time in zip(chain['type'], chain['time'])],
+        }
+        for chain in chains[:limit]
+    ]
+
+def analyze(events, interval=0.1, chains=10) -> dict:
+    start = int(events['time'][0])
+    counts = np.bincount(events['type'], minlength=max(EVENT_NAMES) + 1)
+    rtts = rtt_samples(events)
+    times, counts_in_flight = in_flight(events, start)
+    result_rates = rates(events, start, interval)
+    # packets in-air at the end of each rate interval
+    ends = np.arange(1, len(result_rates['time']) + 1) * interval
+    index = np.searchsorted(times, ends, side='right') - 1
+    result_rates['in_flight'] = np.where(index >= 0, counts_in_flight[index.clip(0)], 0).tolist() if len(times) else []
+    return {
+        'events': len(events),
+        'duration': float((events['time'][-1] - start) / 1e9),
+        'counts': {name: int(counts[type]) for type, name in EVENT_NAMES.items()},
+        'rtt': percentiles(rtts),
+        'in_flight': {'max': int(counts_in_flight.max()) if len(counts_in_flight) else 0,
+                      'mean': float(counts_in_flight.mean()) if len(counts_in_flight) else 0},
+        'rates': result_rates,
+        'retransmission_chains': retransmission_chains(events, start, chains),
+    }
+
+# Sequence-time plot points: time, seq relative to the first one sent and type,
+# for every transmission and ACK
+def write_plot_data(events, path: str):
+    selected = events[np.isin(events['type'], (PKT_SENT, TIMEOUT, FAST_RETX, ACK_RECV))]
+    start = events['time'][0]
+    first_seq = selected['seq'][0] if len(selected) else 0
+    names = np.array([EVENT_NAMES.get(type, '') for type in range(max(EVENT_NAMES) + 1)])
+
+    points = np.empty(len(selected), dtype=[('time', 'f8'), ('seq', 'i8'), ('type', names.dtype)])
+    points['time'] = (selected['time'] - start) / 1e9
+    points['seq'] = (selected['seq'].astype(np.int64) - int(first_seq)) % 2**32
+    points['type'] = names[selected['type']]
+    np.savetxt(path, points, fmt=['%.6f', '%d', '%s'], delimiter=',', header='time,seq,type', comments='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyzes a trace written by the event logger.')
+    parser.add_argument('trace', help='Trace file, JSONL or binary.')
+    parser.add_argument('--interval', help='Seconds per goodput sample.', type=float, default=0.1)
+    parser.add_argument('--chains', help='Retransmission chains reported.', type=int, default=10)
+    parser.add_argument('--json', help='Writes the full analysis to a JSON file.')
+    parser.add_argument('--plot', help='Writes sequence-time plot data to a CSV file.')
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit('ERROR: trace analysis needs NumPy (pip install numpy)')
+
+    events = load_trace(args.trace)
+    if len(events) == 0:
+        sys.exit('ERROR: empty trace')
+    result = analyze(events, args.interval, args.chains)
+
+    print(f"Events: {result['events']} over {result['duration']:.3f}s")
+    print('Counts: ' + ', '.join(f'{name} {count}' for name, count in result['counts'].items() if count))
+    if result['rtt']:
+        rtt = result['rtt']
+        print(f"RTT: p50 {rtt['p50']*1000:.2f} ms, p90 {rtt['p90']*1000:.2f} ms, p99 {rtt['p99']*1000:.2f} ms, "
+              f"max {rtt['max']*1000:.2f} ms")
+    print(f"In-flight: max {result['in_flight']['max']}, mean {result['in_flight']['mean']:.2f}")
+    acked = result['rates']['acked_bps']
+    if acked:
+        print(f"ACKed goodput: mean {sum(acked)/len(acked):.0f} bps, peak {max(acked):.0f} bps")
+    for chain in result['retransmission_chains']:
+        print(f"seq {chain['seq']}: " + ' -> '.join(f'{name}@{time:.3f}s' for name, time in chain['events']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f)
+    if args.plot:
+        write_plot_data(events, args.plot)
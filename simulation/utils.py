@@ -1,15 +1,47 @@
+import os
 import sys
+import mmap
 from constants import DEBUG
 from textwrap import wrap
 
-def getChunks(chunk_size: int, data: str) -> list:
-    chunks = []
+def getChunks(chunk_size: int, data: bytes) -> list:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
 
-    while len(data) > 0:
-        chunks.append(data[:chunk_size])
-        data = data[chunk_size:]
+# Reads a file, or length bytes of it from offset, as chunks of chunk_size
+# bytes, without loading it whole. Files of at least mmap_threshold bytes are
+# mapped instead of read
+def readChunks(path: str, chunk_size: int, mmap_threshold=16 * 1024 * 1024, offset=0, length=None):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if length is None else min(size, offset + length)
+        if size < mmap_threshold:
+            f.seek(offset)
+            while offset < end:
+                chunk = f.read(min(chunk_size, end - offset))
+                if not chunk:
+                    return
+                offset += len(chunk)
+                yield chunk
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for i in range(offset, end, chunk_size):
+                yield mapped[i:min(i + chunk_size, end)]
 
-    return chunks
+# Writes throughput and goodput over the time from the first connection start
+# to the last connection end
+def write_stats(name: str, connections: list):
+    if not connections:
+        return
+    elapsed_time = max(s['end_time'] for s in connections) - min(s['start_time'] for s in connections)
+    elapsed_time = max(elapsed_time, 1e-9)
+    throughput = sum(s['bytes_sent'] + s['bytes_recv'] for s in connections)
+    throughput = throughput*8/elapsed_time
+    goodput = sum(s['sender']['bytes_sent'] + s['recver']['bytes_recv'] for s in connections)
+    goodput = goodput*8/elapsed_time
+    retransmissions = sum(s['sender']['retransmissions'] for s in connections)
+
+    sys.stderr.write(f"{name}: throughput {throughput:.2f} bps, goodput {goodput:.2f} bps, "
+                     f"{retransmissions} retransmissions, {elapsed_time:.3f}s\n")
 
 def debug_log(message):
     if DEBUG: